@@ -0,0 +1,118 @@
+"""Compare the Motion fusion engines on a recorded trace.
+
+    python benchmarks/bench_fusion.py [trace.csv]
+
+Each row of trace.csv is one fuse() call: dt (s), ax, ay, az (g), gx, gy, gz
+(deg/s, gyro offsets removed), optionally followed by the true angleX,
+angleY, angleZ. Without a file a synthetic 20 s trace at 100 Hz is used:
+still, 30 degree tilt about X, still, 90 degree turn, still, with sensor
+noise and a 0.3 deg/s gyro bias left after calibration.
+
+Reports the cost of one update and, over the still parts, the tilt noise and
+how much the heading drifts. Timings are from the host CPU, only the ratio
+between the engines carries over to the board.
+"""
+import math, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests', 'stubs'))
+
+import host
+
+host.install()
+
+import machine
+from makerbit_motion import Motion
+
+
+def synthetic_trace(rate=100, seed=1):
+    rnd = random.Random(seed)
+    dt = 1 / rate
+    # (seconds, roll rate deg/s, yaw rate deg/s)
+    segments = ((5, 0, 0), (1, 30, 0), (5, 0, 0), (2, 0, 45), (7, 0, 0))
+    roll = yaw = 0.0
+    rows = []
+    for seconds, roll_rate, yaw_rate in segments:
+        for _ in range(int(seconds * rate)):
+            roll += roll_rate * dt
+            yaw += yaw_rate * dt
+            r = math.radians(roll)
+            # the turn is about the vertical, seen tilted by the body axes
+            rows.append((dt,
+                rnd.gauss(0, 0.01), math.sin(r) + rnd.gauss(0, 0.01),
+                math.cos(r) + rnd.gauss(0, 0.01),
+                roll_rate + rnd.gauss(0, 0.2) + 0.3,
+                math.sin(r) * yaw_rate + rnd.gauss(0, 0.2) + 0.3,
+                math.cos(r) * yaw_rate + rnd.gauss(0, 0.2) + 0.3,
+                0.0, roll, yaw))
+    return rows
+
+
+def load_trace(path):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rows.append(tuple(float(x) for x in line.split(',')))
+    return rows
+
+
+def still_runs(rows, min_len=100):
+    # indexes of the samples inside stretches without rotation
+    runs = []
+    start = None
+    for i, row in enumerate(rows + [(0, 0, 0, 0, 99, 99, 99)]):
+        still = max(abs(row[4]), abs(row[5]), abs(row[6])) < 2
+        if still and start is None:
+            start = i
+        elif not still and start is not None:
+            if i - start >= min_len:
+                runs.append((start, i))
+            start = None
+    return runs
+
+
+def run(engine, rows):
+    motion = Motion(machine.I2C())
+    motion.begin()
+    motion.fusion(engine)
+    angles = []
+    fuse = motion.fuse
+    t0 = time.perf_counter()
+    for row in rows:
+        fuse(row[1], row[2], row[3], row[4], row[5], row[6], row[0])
+        angles.append((motion.angleX, motion.angleY, motion.angleZ))
+    elapsed = time.perf_counter() - t0
+    return elapsed / len(rows) * 1e6, angles
+
+
+def stats(rows, angles):
+    noise = []
+    drift = []
+    for start, end in still_runs(rows):
+        # skip the first second while the filter settles
+        part = angles[start + (end - start) // 5:end]
+        mean = sum(a[1] for a in part) / len(part)
+        noise.append(math.sqrt(sum((a[1] - mean) ** 2 for a in part) / len(part)))
+        seconds = sum(row[0] for row in rows[start + (end - start) // 5:end])
+        drift.append(abs(part[-1][2] - part[0][2]) / seconds * 60)
+    error = None
+    if len(rows[0]) >= 10:
+        error = max(abs(a[1] - row[8]) for a, row in zip(angles, rows))
+    return max(noise), max(drift), error
+
+
+def main():
+    rows = load_trace(sys.argv[1]) if len(sys.argv) > 1 else synthetic_trace()
+    print('{} samples'.format(len(rows)))
+    print('{:14s} {:>10s} {:>14s} {:>16s} {:>14s}'.format(
+        'engine', 'us/update', 'tilt noise deg', 'heading deg/min', 'max tilt err'))
+    for engine in ('complementary', 'madgwick'):
+        cost, angles = run(engine, rows)
+        noise, drift, error = stats(rows, angles)
+        print('{:14s} {:10.1f} {:14.3f} {:16.2f} {:>14s}'.format(engine, cost,
+            noise, drift, '-' if error is None else '{:.2f}'.format(error)))
+
+
+if __name__ == '__main__':
+    main()
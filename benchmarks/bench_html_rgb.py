@@ -0,0 +1,72 @@
+"""Cost of TCS34725.html_rgb() with the gamma table against the pow() formula
+it replaced, on the same raw readings.
+
+    python benchmarks/bench_html_rgb.py
+
+Timings are from the host CPU. The script also checks both give the same
+colors on every reading it times.
+"""
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests', 'stubs'))
+
+import host
+
+host.install()
+
+from makerbit_tcs34725 import TCS34725
+
+
+def old_html_rgb(r, g, b, c):
+    # html_rgb() before the gamma table
+    if c == 0:
+        return (0, 0, 0)
+    red = int(pow((int((r/c) * 256) / 255), 2.5) * 255)
+    green = int(pow((int((g/c) * 256) / 255), 2.5) * 255)
+    blue = int(pow((int((b/c) * 256) / 255), 2.5) * 255)
+    if red > 255:
+        red = 255
+    if green > 255:
+        green = 255
+    if blue > 255:
+        blue = 255
+    return (red, green, blue)
+
+
+def readings(n=20000, seed=1):
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        c = rnd.randrange(1, 65536)
+        rows.append((rnd.randrange(0, c + 1), rnd.randrange(0, c + 1),
+                     rnd.randrange(0, c + 1), c))
+    return rows
+
+
+def new_html_rgb(rows):
+    # html_rgb() of a sensor whose read() returns the given raw readings
+    tcs = TCS34725.__new__(TCS34725)
+    it = iter(rows)
+    tcs.read = lambda raw=False: next(it)
+    return tcs.html_rgb
+
+
+def main():
+    rows = readings()
+    t0 = time.perf_counter()
+    old = [old_html_rgb(*row) for row in rows]
+    t_old = time.perf_counter() - t0
+
+    html_rgb = new_html_rgb(rows)
+    t0 = time.perf_counter()
+    new = [html_rgb() for _ in rows]
+    t_new = time.perf_counter() - t0
+
+    assert new == old, 'gamma table differs from the formula'
+    for name, t in (('pow() formula', t_old), ('gamma table', t_new)):
+        print('{:14s} {:8.2f} us/call'.format(name, t / len(rows) * 1e6))
+    print('speedup {:.1f}x, {} identical readings'.format(t_old / t_new, len(rows)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
 import machine, math, pca9685, time
-from machine import Pin
+from machine import Pin, Timer
+from micropython import schedule
 from yolobit import *
 from makerbit_ir_receiver import *
+from makerbit_i2c import get_i2c
+from makerbit_lazy import Lazy
+from makerbit_timers import claim_timer, release_timer
 
-ir_rx = IR_RX(Pin(15, Pin.IN))
-ir_rx.start()
+# Built on first use, like motor and servo
+ir_rx = Lazy(lambda: IR_RX(Pin(15, Pin.IN)))
 
 _DC_MOTORS = ((11, 10), (8, 9), (12, 13), (15, 14))
 
@@ -15,11 +19,20 @@ SLOW_DECAY = 1
 """Recirculation current slow decay mode (braking)"""
 
 class DCMotors:
-    def __init__(self, pca9685_obj, freq=50):
+    def __init__(self, pca9685_obj, freq=50, timer_id=1):
         self.pca9685 = pca9685_obj
         self.pca9685.freq(freq)
 
         self.motor_speeds = [0, 0, 0, 0]
+        self._speed = 50
+
+        # timed moves queued with wait=False: (left, right, ms or None, callback)
+        self._queue = []
+        self._current = None
+        self._tail = (0, 0) # wheel speeds once the queue has run
+        self._timer_id = timer_id
+        self._timer = None
+        self._done_ref = self._done # bound once, used from the timer
 
     def speed(self, index, value=None):
         """Set motor speed
@@ -33,32 +46,42 @@ class DCMotors:
 
         if value is None:
             return self.motor_speeds[index]
-            
-        value = max(min(100, value),-100)
-        
-        # save motor speed
-        self.motor_speeds[index] = value
-
-        pp, pn = _DC_MOTORS[index]
-
-        speed = value * 40
-        
-        if speed >= 0:
-            self.pca9685.pwm(pp, 0, speed)
-            self.pca9685.pwm(pn, 0, 0)
-        else:
-            self.pca9685.pwm(pp, 0, 0)
-            self.pca9685.pwm(pn, 0, -speed)
+
+        self.speeds({index: value})
+
+    def speeds(self, values):
+        """Set several motor speeds in as few I2C transactions as possible
+
+        Args:
+            values (dict): {motor index 0-3: speed -100~100}
+        """
+        channels = {}
+        for index, value in values.items():
+            if index > 3 or index < 0:
+                continue
+
+            value = max(min(100, value),-100)
+
+            # save motor speed
+            self.motor_speeds[index] = value
+
+            pp, pn = _DC_MOTORS[index]
+
+            speed = value * 40
+
+            if speed >= 0:
+                channels[pp] = (0, speed)
+                channels[pn] = (0, 0)
+            else:
+                channels[pp] = (0, 0)
+                channels[pn] = (0, -speed)
+
+        self.pca9685.pwm_many(channels)
 
     def brake(self, index):
         if index > 3 or index < 0:
             return        
-        # save motor speed
-        self.motor_speeds[index] = 0
-
-        pp, pn = _DC_MOTORS[index]
-        self.pca9685.pwm(pp, 0, 0)
-        self.pca9685.pwm(pn, 0, 0)
+        self.speeds({index: 0})
     
     def move(self, dir, speed=None):
 
@@ -100,47 +123,134 @@ class DCMotors:
             self.stop()
 
     def set_wheel_speed(self, left_wheel_speed, right_wheel_speed):
-        self.speed(0, int(left_wheel_speed))
-        self.speed(1, int(right_wheel_speed))
+        # both wheels share channels 8-11 so they are updated in one write
+        self.speeds({0: int(left_wheel_speed), 1: int(right_wheel_speed)})
+
+    # Motion queue
+    def enqueue(self, left_wheel_speed, right_wheel_speed, t=None, callback=None):
+        """Queue a move and return immediately
+
+        Args:
+            left_wheel_speed, right_wheel_speed (number): -100~100
+            t (number): seconds to move before stopping, None to keep the
+                speeds and go on with the next move right away
+            callback: called with no argument when the move is done
+        """
+        ms = None if t is None else int(t * 1000)
+        if ms is not None and self._timer is None:
+            # held until the queue is empty, raises if another driver uses it
+            self._timer = claim_timer(self._timer_id, self)
+        self._queue.append((left_wheel_speed, right_wheel_speed, ms, callback))
+        self._tail = (0, 0) if ms is not None else (left_wheel_speed, right_wheel_speed)
+        if self._current is None:
+            self._next()
+
+    def busy(self):
+        return self._current is not None or len(self._queue) > 0
+
+    def wait(self):
+        """Block until the queued moves are done"""
+        while self.busy():
+            time.sleep_ms(10)
+
+    def cancel(self, stop=True):
+        """Drop the queued moves, their callbacks are not called"""
+        self._queue = []
+        self._current = None
+        self._release_timer()
+        if stop:
+            self.stop()
+
+    def _tail_speeds(self):
+        if self.busy():
+            return self._tail
+        return self.motor_speeds[0], self.motor_speeds[1]
+
+    def _next(self):
+        while self._queue:
+            self._current = self._queue.pop(0)
+            left, right, ms, callback = self._current
+            self.set_wheel_speed(left, right)
+            if ms is not None:
+                self._timer.init(period=max(1, ms), mode=Timer.ONE_SHOT,
+                    callback=self._timer_cb)
+                return
+            if callback:
+                callback()
+        self._current = None
+        self._release_timer()
+
+    def _release_timer(self):
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+            release_timer(self._timer_id, self)
+
+    def _timer_cb(self, _):
+        # the wheels are driven over I2C, not allowed in a hard interrupt
+        try:
+            schedule(self._done_ref, 0)
+        except RuntimeError:
+            # schedule queue full, try again shortly
+            if self._timer:
+                self._timer.init(period=1, mode=Timer.ONE_SHOT, callback=self._timer_cb)
+
+    def _done(self, _):
+        if self._current is None: # cancelled
+            return
+        callback = self._current[3]
+        self.stop()
+        if callback:
+            callback()
+        self._next()
+
+    def _run(self, left, right, t, wait, callback=None):
+        if wait:
+            self.cancel(False)
+            self.set_wheel_speed(left, right)
+            if t != None:
+                time.sleep(t)
+                self.stop()
+            if callback:
+                callback()
+        else:
+            self.enqueue(left, right, t, callback)
     
-    def __go(self, forward=True, speed=None, t=None):
+    def __go(self, forward=True, speed=None, t=None, wait=True, callback=None):
+        if speed == None:
+            speed = self._speed
 
         if speed < 0 or speed > 100 or (t != None and t < 0):
             return
 
+        left, right = self._tail_speeds()
+
         if forward:
-          # stop first if robot is moving forward
-          if self.m1_speed < 0 and self.m2_speed < 0:
-              self.stop()
-              time.sleep_ms(300)
+          # stop first if robot is moving backward
+          if left < 0 and right < 0:
+              self._run(0, 0, 0.3, wait)
 
-          self.set_wheel_speed(speed, speed)
+          self._run(speed, speed, t, wait, callback)
         else:
           # stop first if robot is moving forward
-          if self.m1_speed > 0 and self.m2_speed > 0:
-              self.stop()
-              time.sleep_ms(300)
+          if left > 0 and right > 0:
+              self._run(0, 0, 0.3, wait)
 
-          self.set_wheel_speed(-speed, -speed)
-
-        if t != None :
-            time.sleep(t)
-            self.stop()
+          self._run(-speed, -speed, t, wait, callback)
     
-    def __turn_backward(self, right=True, speed=None, t=None):
+    def __turn_backward(self, right=True, speed=None, t=None, wait=True, callback=None):
+        if speed == None:
+            speed = self._speed
+
         if speed < 0 or speed > 100 or (t != None and t < 0):
             return
 
         if right:
-            self.set_wheel_speed(-speed, -speed/2)
+            self._run(-speed, -speed/2, t, wait, callback)
         else:
-            self.set_wheel_speed(-speed/2, -speed)            
-
-        if t != None :
-            time.sleep(t)
-            self.stop()
+            self._run(-speed/2, -speed, t, wait, callback)
 
-    def __turn(self, right=True, speed=30, t=None):
+    def __turn(self, right=True, speed=None, t=None, wait=True, callback=None):
         if speed == None:
             speed = self._speed
             
@@ -148,37 +258,30 @@ class DCMotors:
             return
 
         if right:
-            self.set_wheel_speed(speed, -speed)
+            self._run(speed, -speed, t, wait, callback)
         else:
-            self.set_wheel_speed(-speed, speed)
-
-        if t != None :
-            time.sleep(t)
-            self.stop()
+            self._run(-speed, speed, t, wait, callback)
     
-    def forward(self, speed=None, t=None):
-        self.__go(True, speed, t)
+    def forward(self, speed=None, t=None, wait=True, callback=None):
+        self.__go(True, speed, t, wait, callback)
 
-    def backward(self, speed=None, t=None):
-        self.__go(False, speed, t)
+    def backward(self, speed=None, t=None, wait=True, callback=None):
+        self.__go(False, speed, t, wait, callback)
 
-    def turn_left(self, speed=None, t=None):
-        self.__turn(False, speed, t)
+    def turn_left(self, speed=None, t=None, wait=True, callback=None):
+        self.__turn(False, speed, t, wait, callback)
 
-    def turn_right(self, speed=None, t=None):
-        self.__turn(True, speed, t)
+    def turn_right(self, speed=None, t=None, wait=True, callback=None):
+        self.__turn(True, speed, t, wait, callback)
     
-    def turn_left_backward(self, speed=None, t=None):
-        self.__turn_backward(False, speed, t)
+    def turn_left_backward(self, speed=None, t=None, wait=True, callback=None):
+        self.__turn_backward(False, speed, t, wait, callback)
 
-    def turn_right_backward(self, speed=None, t=None):
-        self.__turn_backward(True, speed, t)
+    def turn_right_backward(self, speed=None, t=None, wait=True, callback=None):
+        self.__turn_backward(True, speed, t, wait, callback)
 
     def stop(self):
-        self.speed(0, 0)
-        self.speed(1, 0)
-        self.speed(2, 0)
-        self.speed(3, 0)
+        self.speeds({0: 0, 1: 0, 2: 0, 3: 0})
 
     # Stepper Function
     def _pin(self, pin, value):
@@ -188,10 +291,11 @@ class DCMotors:
             self.pca9685.pwm(pin, 0, 0)    
     
     def setStepper(self,in1, in2, in3, in4):
-        self._pin(_DC_MOTORS[0][0], in1)
-        self._pin(_DC_MOTORS[0][1], in2)
-        self._pin(_DC_MOTORS[1][0], in3)
-        self._pin(_DC_MOTORS[1][1], in4)
+        channels = {}
+        for pin, value in ((_DC_MOTORS[0][0], in1), (_DC_MOTORS[0][1], in2),
+                           (_DC_MOTORS[1][0], in3), (_DC_MOTORS[1][1], in4)):
+            channels[pin] = (4096, 0) if value == 1 else (0, 0)
+        self.pca9685.pwm_many(channels)
     
     def unclockwise(self,step, delay=10):
         for y in range(step):
@@ -246,11 +350,33 @@ class Servos:
     if degrees < 2 and max_degrees == 270:
       degrees = 2
 
+    self.pca9685.duty(index, self._degrees2duty(degrees, max_degrees))
+    self.pos[index] = degrees
+
+  def positions(self, degrees, max_degrees=180):
+    """Move servos 0..len(degrees)-1 together in one I2C transaction"""
+    if len(degrees) > 8:
+      return
+
+    for value in degrees:
+      if value < 0 or value > max_degrees:
+        return
+
+    duties = []
+    for index, value in enumerate(degrees):
+      # Lego servo 270 not working with 0 degree
+      if value < 2 and max_degrees == 270:
+        value = 2
+
+      duties.append(self._degrees2duty(value, max_degrees))
+      self.pos[index] = value
+
+    self.pca9685.duty_range(0, duties)
+
+  def _degrees2duty(self, degrees, max_degrees):
     span = self.max_duty - self.min_duty
     duty = self.min_duty + span * degrees / max_degrees
-    duty = min(self.max_duty, max(self.min_duty, int(duty)))
-    self.pca9685.duty(index, duty)
-    self.pos[index] = degrees
+    return min(self.max_duty, max(self.min_duty, int(duty)))
 
   def rotate(self, index, change=2, sleep=10, limit=None, max_degrees=180):
     if index < 0 or index > 7:
@@ -268,16 +394,16 @@ class Servos:
       if (change <= 0 and new_pos < limit) or (change > 0 and new_pos > limit):
         return
 
-      span = self.max_duty - self.min_duty
-      duty = self.min_duty + span * new_pos / max_degrees
-      duty = min(self.max_duty, max(self.min_duty, int(duty)))
-      self.pca9685.duty(index, duty)
+      self.pca9685.duty(index, self._degrees2duty(new_pos, max_degrees))
       self.pos[index] = new_pos
       time.sleep_ms(sleep)
 
   def release(self, index):
     self.pca9685.duty(index, 0)
 
+  def release_all(self):
+    self.pca9685.duty_range(0, [0] * 8)
+
   def spin(self, index, speed):
     if index < 0 or index > 7 or speed < -100 or speed > 100:
       return
@@ -289,16 +415,16 @@ class Servos:
     degree = 90 - (speed/100)*90
     self.position(index, degree)
 
-try:
-    from machine import SoftI2C
-    __i2c = SoftI2C(scl=Pin(22), sda=Pin(21), freq=200000)
-except Exception as e:
-    print("SoftI2C not exist. Using old I2C", e)
-    from machine import I2C
-    __i2c = I2C(scl=Pin(22), sda=Pin(21), freq=200000)
-
-pca9685_obj = pca9685.PCA9685(__i2c, 0x40)
-motor = DCMotors(pca9685_obj)
-servo = Servos(pca9685_obj)
+_pca9685_obj = None
+
+def _get_pca9685():
+    global _pca9685_obj
+    if _pca9685_obj is None:
+        _pca9685_obj = pca9685.PCA9685(get_i2c(), 0x40)
+    return _pca9685_obj
+
+pca9685_obj = Lazy(_get_pca9685)
+motor = Lazy(lambda: DCMotors(_get_pca9685()))
+servo = Lazy(lambda: Servos(_get_pca9685()))
 
 
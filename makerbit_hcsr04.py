@@ -1,5 +1,8 @@
 import machine, time
-from machine import Pin
+from machine import Pin, Timer
+from micropython import schedule
+from array import array
+from makerbit_timers import claim_timer, release_timer
 
 __version__ = '0.2.0'
 __author__ = 'Roberto Sánchez'
@@ -14,16 +17,34 @@ class HCSR04:
     The timeouts received listening to echo pin are converted to OSError('Out of range')
     """
     # echo_timeout_us is based in chip range limit (400cm)
-    def __init__(self, trigger_pin, echo_pin, echo_timeout_us=500*2*30):
+    def __init__(self, trigger_pin, echo_pin, echo_timeout_us=500*2*30, window=5, max_age_ms=500):
         """
         trigger_pin: Output pin to send pulses
         echo_pin: Readonly pin to measure the distance. The pin should be protected with 1k resistor
         echo_timeout_us: Timeout in microseconds to listen to echo pin. 
         By default is based in sensor limit range (4m)
+        window: Number of recent readings the filter takes the median of
+        max_age_ms: Readings older than this (relative to the newest one) are ignored by the filter
         """
         self.echo_timeout_us = echo_timeout_us
-        self._ars = []
-        self._ats = []
+        self.max_age_ms = max_age_ms
+        # fixed size ring of readings and their time, plus sorting scratch
+        self._ars = array('f', [0] * window)
+        self._ats = array('i', [0] * window)
+        self._sorted = array('f', [0] * window)
+        self._head = 0
+        self._count = 0
+
+        # async mode state, written by the echo pin IRQ
+        self._async = False
+        self._busy = False
+        self._new = False
+        self._echo_start = 0
+        self._ping_ticks = 0
+        self._pulse_time = 0
+        self._pulse_ticks = None
+        self._cms = _MAX_DISTANCE_CM
+        self._distance = _MAX_DISTANCE_CM
         # Init trigger pin (out)
         self.trigger = Pin(trigger_pin, mode=Pin.OUT, pull=None)
         self.trigger.value(0)
@@ -50,16 +71,85 @@ class HCSR04:
                 raise OSError('Out of range')
             raise ex
 
-    def distance_mm(self):
-        return self.distance_cm()*10
+    def async_mode(self, value=None):
+        """
+        Enable or disable the asynchronous mode.
+        In this mode the echo edges are timestamped by a pin IRQ and
+        `distance_cm()` returns the newest distance at once, starting the
+        next measurement in the background. Use `distance_age_ms()` to know
+        how old the returned value is.
+        """
+        if value is None:
+            return self._async
+        value = bool(value)
+        if self._async == value:
+            return
+        self._async = value
+        self._busy = self._new = False
+        if value:
+            trigger = Pin.IRQ_RISING | Pin.IRQ_FALLING
+            try:
+                # hard IRQ: the edge is timestamped at once, not when the
+                # scheduler gets to it (58us late is 1cm off)
+                self.echo.irq(handler=self._echo_irq, trigger=trigger, hard=True)
+            except TypeError:
+                self.echo.irq(handler=self._echo_irq, trigger=trigger)
+        else:
+            self.echo.irq(handler=None)
 
-    def distance_cm(self, filter=True):
+    def _echo_irq(self, pin):
+        # hard IRQ: only stores small ints in attributes set in __init__
+        t = time.ticks_us()
+        if pin.value():
+            self._echo_start = t
+        elif self._busy:
+            self._pulse_time = time.ticks_diff(t, self._echo_start)
+            self._pulse_ticks = time.ticks_ms()
+            self._busy = False
+            self._new = True
+
+    def ping(self):
         """
-        Get the distance in centimeters with floating point operations.
-        It returns a float
+        Send a trigger pulse without waiting for the echo (async mode).
+        Does nothing while the previous echo is still expected.
         """
-        pulse_time = self._send_pulse_and_wait()
+        now = time.ticks_ms()
+        if self._busy and time.ticks_diff(now, self._ping_ticks) < self.echo_timeout_us // 1000 + 30:
+            return
+        self._ping_ticks = now
+        self._busy = True
+        self.trigger.value(0)
+        time.sleep_us(5)
+        self.trigger.value(1)
+        time.sleep_us(10)
+        self.trigger.value(0)
 
+    def distance_age_ms(self):
+        """
+        Age in milliseconds of the last echo received in async mode, None if
+        there is none yet
+        """
+        if self._pulse_ticks is None:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self._pulse_ticks)
+
+    def _collect(self):
+        """
+        Filter the echo received by the IRQ since the last call, if any.
+        Returns True when a new reading was collected.
+        """
+        if not self._new:
+            return False
+        self._new = False
+        if self._pulse_time > self.echo_timeout_us:
+            self._cms = _MAX_DISTANCE_CM
+        else:
+            self._cms = self._pulse_to_cm(self._pulse_time)
+        self._push(self._cms)
+        self._distance = self._filtered()
+        return True
+
+    def _pulse_to_cm(self, pulse_time):
         # To calculate the distance we get the pulse_time and divide it by 2 
         # (the pulse walk the distance twice) and by 29.1 becasue
         # the sound speed on air (343.2 m/s), that It's equivalent to
@@ -68,44 +158,146 @@ class HCSR04:
         
         if cms < 0 or cms > _MAX_DISTANCE_CM:
             cms = _MAX_DISTANCE_CM
+        return cms
+
+    def distance_mm(self):
+        return self.distance_cm()*10
+
+    def distance_cm(self, filter=True):
+        """
+        Get the distance in centimeters with floating point operations.
+        It returns a float
+        """
+        if self._async:
+            self._collect()
+            self.ping()
+            return self._distance if filter else self._cms
+
+        pulse_time = self._send_pulse_and_wait()
+        cms = self._pulse_to_cm(pulse_time)
 
         if not filter:
             return cms
         
-        self._ars.append(cms)
-        self._ats.append(time.time_ns())
-        if len(self._ars) > 5:
-            self._ars.pop(0)
-            self._ats.pop(0)
-        while True:
-            if self._ats[len(self._ats) - 1] - self._ats[0] > 5e8:
-                self._ars.pop(0)
-                self._ats.pop(0)
-            else:
-                break
-        if len(self._ars) < 2:
+        self._push(cms)
+        if self._recent() < 2:
             time.sleep_ms(30)
             pulse_time = self._send_pulse_and_wait()
-            cms = (pulse_time / 2) / 29.1
-            if cms < 0 or cms > _MAX_DISTANCE_CM:
-                cms = _MAX_DISTANCE_CM
-            self._ars.append(cms)
-            self._ats.append(time.time_ns())
-        
-        N = len(self._ars)
-        Fi = Fd = [1] * N
-        maxd = vald = 0
-        for i in range(N):
-            for j in range(i):
-                if (self._ars[i] >= self._ars[j]) and (self._ars[i] - self._ars[j]) < 10:
-                    Fi[i] = max(Fi[i], Fi[j] + 1)
-                if (self._ars[i] <= self._ars[j]) and (self._ars[j] - self._ars[i]) < 10:
-                    Fd[i] = max(Fd[i], Fd[j] + 1)
-                if maxd < Fi[i] or maxd < Fd[i]:
-                    maxd = max(Fi[i], Fd[i])
-                    vald = self._ars[i]
-
-        if maxd <= N/2:
-            vald = sum(self._ars) / N
-        
+            self._push(self._pulse_to_cm(pulse_time))
+
+        return self._filtered()
+
+    def _push(self, cms):
+        self._ars[self._head] = cms
+        self._ats[self._head] = time.ticks_ms()
+        self._head = (self._head + 1) % len(self._ars)
+        if self._count < len(self._ars):
+            self._count += 1
+
+    def _recent(self):
+        """
+        Copy the readings not older than max_age_ms before the newest one
+        into the sorted scratch array, returns how many there are
+        """
+        size = len(self._ars)
+        newest = self._ats[(self._head - 1) % size]
+        n = 0
+        for k in range(self._count):
+            i = (self._head - 1 - k) % size
+            if time.ticks_diff(newest, self._ats[i]) > self.max_age_ms:
+                break
+            # insertion sort, the window is small and fixed
+            val = self._ars[i]
+            j = n
+            while j > 0 and self._sorted[j - 1] > val:
+                self._sorted[j] = self._sorted[j - 1]
+                j -= 1
+            self._sorted[j] = val
+            n += 1
+        return n
+
+    def _filtered(self):
+        # median of the recent readings rejects isolated outliers (echo
+        # misses reported as _MAX_DISTANCE_CM, ghost echoes)
+        n = self._recent()
+        if n % 2:
+            vald = self._sorted[n // 2]
+        else:
+            vald = (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2
         return round(vald * 10) / 10
+
+
+class HCSR04Scheduler:
+    """
+    Drive several HCSR04 sensors from a timer, one at a time.
+    Every `guard_ms` the echo of the previous sensor is collected and the next
+    sensor is triggered, so echoes of different sensors never overlap.
+    The latest filtered distance of each sensor is cached and can be read
+    at any time without waiting.
+    """
+    def __init__(self, sensors, guard_ms=40, timer_id=0):
+        """
+        sensors: List of HCSR04 instances, they are switched to async mode
+        guard_ms: Time between two triggers, must exceed the echo time of the farthest object
+        timer_id: Hardware timer used for the round-robin
+        """
+        self.sensors = sensors
+        self.guard_ms = guard_ms
+        self._timer_id = timer_id
+        self._timer = None
+        self._current = 0
+        self._distances = array('f', [_MAX_DISTANCE_CM] * len(sensors))
+        self._ticks = array('i', [0] * len(sensors))
+        self._valid = bytearray(len(sensors))
+        self._tick_ref = self._tick # bound once, used from the timer
+        for sensor in sensors:
+            sensor.async_mode(True)
+
+    def start(self):
+        self.stop()
+        self._timer = claim_timer(self._timer_id, self)
+        self._timer.init(period=self.guard_ms, mode=Timer.PERIODIC, callback=self._timer_cb)
+        self.sensors[self._current].ping()
+
+    def stop(self):
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+            release_timer(self._timer_id, self)
+
+    def _timer_cb(self, _):
+        try:
+            schedule(self._tick_ref, 0)
+        except RuntimeError: # schedule queue full, try again next period
+            pass
+
+    def _tick(self, _):
+        i = self._current
+        sensor = self.sensors[i]
+        if sensor._collect():
+            self._distances[i] = sensor._distance
+            self._ticks[i] = sensor._pulse_ticks
+            self._valid[i] = 1
+        self._current = (i + 1) % len(self.sensors)
+        self.sensors[self._current].ping()
+
+    def distances(self):
+        """
+        Latest distance in cm of every sensor, as a shared array that is
+        updated in place
+        """
+        return self._distances
+
+    def distance_cm(self, index):
+        return self._distances[index]
+
+    def distance_mm(self, index):
+        return self._distances[index] * 10
+
+    def age_ms(self, index):
+        """
+        Age in milliseconds of the cached distance, None if there is none yet
+        """
+        if not self._valid[index]:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self._ticks[index])
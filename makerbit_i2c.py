@@ -0,0 +1,44 @@
+from machine import Pin
+
+# Shared I2C buses, keyed by (scl, sda) pin numbers. Every Maker:Bit driver
+# asks for its bus here so that the PCA9685, MPU6050 and TCS34725 on pins
+# 22/21 use one bus object instead of three bit-banged ones.
+_buses = {}
+_freqs = {}
+# hardware I2C peripherals of the ESP32. Each one is a singleton, so every pin
+# pair needs its own ID, creating I2C(0) again would move the first bus.
+_HW_IDS = (0, 1)
+_hw_used = []
+
+def get_i2c(scl=22, sda=21, freq=400000):
+    """Return the shared I2C bus on the given pins, creating it on first use.
+    Hardware I2C is preferred, SoftI2C is used when it is not available or
+    both hardware peripherals are taken by other pins.
+    """
+    key = (scl, sda)
+    if key not in _buses:
+        bus = None
+        if len(_hw_used) < len(_HW_IDS):
+            hw_id = _HW_IDS[len(_hw_used)]
+            try:
+                from machine import I2C
+                bus = I2C(hw_id, scl=Pin(scl), sda=Pin(sda), freq=freq)
+                _hw_used.append(hw_id)
+            except Exception as e:
+                print("Hardware I2C not available. Using SoftI2C", e)
+        if bus is None:
+            try:
+                from machine import SoftI2C
+                bus = SoftI2C(scl=Pin(scl), sda=Pin(sda), freq=freq)
+            except Exception as e:
+                print("SoftI2C not exist. Using old I2C", e)
+                from machine import I2C
+                bus = I2C(scl=Pin(scl), sda=Pin(sda), freq=freq)
+        _buses[key] = bus
+        _freqs[key] = freq
+    return _buses[key]
+
+def i2c_freq(scl=22, sda=21):
+    """Return the frequency of the shared bus on the given pins, or None if it
+    has not been created yet"""
+    return _freqs.get((scl, sda))
@@ -1,11 +1,11 @@
 # Author: Peter Hinch
 # Copyright Peter Hinch 2020-2021 Released under the MIT license
 
-import gc
 from machine import Timer, Pin
 from array import array
-from utime import ticks_us, ticks_diff
-from micropython import const
+from utime import ticks_us, ticks_ms, ticks_diff
+from micropython import const, schedule
+from makerbit_timers import claim_timer, release_timer
 
 # Save RAM
 from micropython import alloc_emergency_exception_buf
@@ -57,17 +57,67 @@ _errors = {_BADSTART : 'Invalid start pulse',
            _BADDATA : 'Error: invalid data',
            _BADADDR : 'Error: invalid address'}
 
-# IR remote control NEC protocol decoder using synchronous code
+# IR remote control decoder using synchronous code
 # For a remote using NEC see https://www.adafruit.com/products/389
 _EDGES = const(68)
 _TBLOCK = const(80)
 
+# Protocols, passed as ext to the callback
+IR_NEC = const(0)
+IR_NEC_EXT = const(1)
+IR_SAMSUNG = const(2)
+IR_SONY = const(3)
+IR_RC5 = const(4)
+
+# Bit codings
+_SPACE = const(0)  # pulse distance: bit value in the space after each mark
+_MARK = const(1)  # pulse width: bit value in the mark length
+_MANCHESTER = const(2)  # bi-phase, no leader
+_REPEAT_CODE = const(3)  # leader only
+
+# Timing table: protocol, leader mark (µs), leader space (µs, 0 if there is
+# no leader), edges per frame (0 if variable), block time (ms), coding,
+# bit threshold (µs). The frame is decoded as soon as the number of edges
+# is reached, the block timer is only a fallback.
+_PROTOCOLS = (
+    (IR_NEC, 9000, 4500, 68, 80, _SPACE, 1120),
+    (IR_NEC, 9000, 2250, 4, 80, _REPEAT_CODE, 0),
+    (IR_SAMSUNG, 4500, 4500, 68, 80, _SPACE, 1120),
+    (IR_SONY, 2400, 600, 26, 30, _MARK, 900),  # SIRC 12 bits
+    (IR_RC5, 889, 0, 0, 28, _MANCHESTER, 1333),
+)
+_RC5 = const(4)  # index of RC5 in _PROTOCOLS
+
+# Frames of protocols without repeat codes sent again within this time are
+# reported as repeats
+_TREPEAT = const(150)
+
+# Key event kinds
+IR_PRESS = const(0)
+IR_HOLD = const(1)
+IR_RELEASE = const(2)
+
+# event counters stay below this, small ints on every port
+_COUNTER_MAX = const(0x3fffffff)
+
+_RAW_NONE = const(0)
+_RAW_DATA = const(1)
+_RAW_UNSUPPORTED = const(2)
+
 class IR_RX():
-    def __init__(self, pin, callback=None, error_callback=None):
+    def __init__(self, pin, callback=None, error_callback=None, queue_size=16,
+                 release_ms=120, hold_repeat_ms=0, timer_id=3):
         self._pin = pin
         self._callback = callback
         self._error_callback = error_callback
+        self._release_callback = None
+        # A held key is released when no frame arrives within release_ms
+        # (NEC remotes send a repeat code every ~108ms)
+        self.release_ms = release_ms
+        # Minimum time between two hold events/callbacks, 0 for every repeat
+        self.hold_repeat_ms = hold_repeat_ms
         self._tim = None
+        self._timer_id = timer_id  # block and release timer, see makerbit_timers
         self.verbose = False
 
         self._extended = False
@@ -75,64 +125,193 @@ class IR_RX():
 
         self._key_pressed = None
         self._last_key_pressed = None
-        self._raw_code = None
+        self._held = False
+        self._hold_ticks = 0
+        self._held_addr = 0
+
+        # raw code is only formatted when get_raw_code() asks for it
+        self._raw_state = _RAW_NONE
+        self._raw_cmd = 0
+        self._raw_addr = 0
+
+        # preallocated slot for the frame handed to the user callback
+        self._frame = array('i', (0, 0, 0, 0, 0)) # cmd, addr, ext, released key, error
+        self._run_callback_ref = self._run_callback
+        self._run_release_callback_ref = self._run_release_callback
+        self._release_ref = self._release_timeout
+
+        # ring of (cmd, addr, ticks_ms, kind) events, oldest dropped on overflow.
+        # The decoder runs from the scheduler, between any two bytecodes of
+        # the reader, so each side has its own running counter: only the
+        # decoder writes _event_in, only read_event() writes _event_out.
+        self._events = array('i', (0 for _ in range(4 * queue_size)))
+        self._event_in = 0
+        self._event_out = 0
+        # multiple of the ring size, so slots follow on when counters wrap
+        self._event_wrap = _COUNTER_MAX // queue_size * queue_size
+        self.overflows = 0
+        self._run_error_callback_ref = self._run_error_callback
 
         self._times = array('i',  (0 for _ in range(_EDGES + 1)))  # +1 for overrun
         self.edge = 0
+        self._proto = -1  # index in _PROTOCOLS of the frame being received
+        self._need = 0  # edges of a complete frame, 0 if not known
+        self._done = False
+        self._protocol = IR_NEC  # protocol of the last frame
+        self._frame_ticks = 0
+        self._toggle = -1
+        self._rc5_addr = 0
+        self._rc5_toggle = 0
         self.cb = self._decode
+        self._decode_ref = self._decode
         self.start()
 
     # Pin interrupt. Save time of each edge for later decode.
     def _cb_pin(self, line):
         t = ticks_us()
         # On overrun ignore pulses until software timer times out
-        if self.edge <= _EDGES:  # Allow 1 extra pulse to record overrun
+        if self.edge <= _EDGES and not self._done:  # Allow 1 extra pulse to record overrun
             if not self.edge:  # First edge received
+                self._proto = -1
+                self._need = 0
                 self._tim.init(period=_TBLOCK, mode=Timer.ONE_SHOT, callback=self.cb)
             self._times[self.edge] = t
             self.edge += 1
+            if self.edge == 2 or self.edge == 3:
+                self._match()
+            elif self.edge == self._need:
+                # Whole frame received, no need to wait for the block timer
+                self._done = True
+                self._tim.deinit()
+                try:
+                    schedule(self._decode_ref, 0)
+                except RuntimeError:
+                    # schedule queue full, let the block timer decode it
+                    self._done = False
+                    self._tim.init(period=1, mode=Timer.ONE_SHOT, callback=self.cb)
+
+    # Find the protocol from the leader
+    def _match(self):
+        mark = ticks_diff(self._times[1], self._times[0])
+        if self.edge == 2:
+            if mark < 2000:  # No leader, first mark is 1 or 2 RC5 half bits
+                self._proto = _RC5
+                self._tim.init(period=_PROTOCOLS[_RC5][4], mode=Timer.ONE_SHOT, callback=self.cb)
+            return
+        if self._proto == _RC5:
+            return
+        space = ticks_diff(self._times[2], self._times[1])
+        for i in range(len(_PROTOCOLS)):
+            p = _PROTOCOLS[i]
+            # Accept +/-25% timing error
+            if p[2] and abs(mark - p[1]) < p[1] >> 2 and abs(space - p[2]) < p[2] >> 2:
+                self._proto = i
+                self._need = p[3]
+                if p[4] != _TBLOCK:
+                    self._tim.init(period=p[4], mode=Timer.ONE_SHOT, callback=self.cb)
+                return
 
     def _decode(self, _):
+        # Runs in the timer callback: no exceptions, no big ints, no strings
         if self.verbose:
             self._print_raw()
 
-        try:
-            if self.edge > 68:
-                raise RuntimeError(_OVERRUN)
-            width = ticks_diff(self._times[1], self._times[0])
-            #if width < 4000:  # 9ms leading mark for all valid data
-            #    raise RuntimeError(BADSTART)
-            width = ticks_diff(self._times[2], self._times[1])
-            if width > 2500:  # 4.5ms space for normal data
-                #if self.edge < 68:  # Haven't received the correct number of edges
-                #    raise RuntimeError(BADBLOCK)
+        addr = 0
+        ext = IR_NEC
+        if self.edge > _EDGES:
+            cmd = _OVERRUN
+        elif self._proto < 0:
+            cmd = _BADSTART
+        else:
+            p = _PROTOCOLS[self._proto]
+            ext = p[0]
+            coding = p[5]
+            if coding == _REPEAT_CODE:
+                cmd = _REPEAT
+                addr = self._addr  # REPEAT uses last address
+            elif self.edge < p[3]:  # Haven't received the correct number of edges
+                cmd = _BADBLOCK
+            elif coding == _SPACE:
                 # Time spaces only (marks are always 562.5µs)
                 # Space is 1.6875ms (1) or 562.5µs (0)
                 # Skip last bit which is always 1
-                val = 0
-                for edge in range(3, 68 - 2, 2):
-                    val >>= 1
-                    if ticks_diff(self._times[edge + 1], self._times[edge]) > 1120:
-                        val |= 0x80000000
-            elif width > 110: # 2.5ms space for a repeat code. Should have exactly 4 edges.
-                raise RuntimeError(_REPEAT if (self.edge >= 3 or self.edge <= 8) else _BADREP)  # Treat REPEAT as error.
+                # Bits are LSB first, kept in two 16 bit halves to stay small ints
+                low = high = 0
+                for bit in range(32):
+                    edge = 3 + 2 * bit
+                    if ticks_diff(self._times[edge + 1], self._times[edge]) > p[6]:
+                        if bit < 16:
+                            low |= 1 << bit
+                        else:
+                            high |= 1 << (bit - 16)
+                addr = low & 0xff  # 8 bit addr
+                cmd = high & 0xff
+                #if cmd != (high >> 8) ^ 0xff:
+                #    cmd = _BADDATA
+                if ext == IR_NEC and addr != ((low >> 8) ^ 0xff) & 0xff:  # 8 bit addr doesn't match check
+                    #if not self._extended:
+                    #    cmd = _BADADDR
+                    addr |= low & 0xff00  # pass assumed 16 bit address to callback
+                    ext = IR_NEC_EXT
+            elif coding == _MARK:
+                # Sony SIRC: 7 command bits then 5 address bits, LSB first
+                # Mark is 1.2ms (1) or 0.6ms (0)
+                cmd = 0
+                for bit in range(12):
+                    edge = 2 + 2 * bit
+                    if ticks_diff(self._times[edge + 1], self._times[edge]) > p[6]:
+                        if bit < 7:
+                            cmd |= 1 << bit
+                        else:
+                            addr |= 1 << (bit - 7)
             else:
-                raise RuntimeError(_BADSTART)
-            addr = val & 0xff  # 8 bit addr
-            cmd = (val >> 16) & 0xff
-            #if cmd != (val >> 24) ^ 0xff:
-            #    raise RuntimeError(_BADDATA)
-            if addr != ((val >> 8) ^ 0xff) & 0xff:  # 8 bit addr doesn't match check
-                #if not self._extended:
-                #    raise RuntimeError(_BADADDR)
-                addr |= val & 0xff00  # pass assumed 16 bit address to callback
-            self._addr = addr
-        except RuntimeError as e:
-            cmd = e.args[0]
-            addr = self._addr if cmd == _REPEAT else 0  # REPEAT uses last address
+                cmd = self._decode_rc5(p[6])
+                addr = self._rc5_addr
+            if cmd >= 0:
+                # Protocols without repeat codes send the whole frame again
+                now = ticks_ms()
+                if ext == IR_RC5:
+                    repeat = self._rc5_toggle == self._toggle
+                    self._toggle = self._rc5_toggle
+                else:
+                    repeat = ext != IR_NEC and ext != IR_NEC_EXT and \
+                        ticks_diff(now, self._frame_ticks) < _TREPEAT
+                if repeat and cmd == self._last_key_pressed and addr == self._addr:
+                    cmd = _REPEAT
+                self._frame_ticks = now
+                self._addr = addr
+                self._protocol = ext
         # Set up for new data burst and run user callback
-        self.do_callback(cmd, addr, 0, _REPEAT)
-        gc.collect()
+        self.do_callback(cmd, addr, ext, _REPEAT)
+
+    def _decode_rc5(self, threshold):
+        # Manchester coded, 889µs half bits, 14 bits MSB first. A 1 is a space
+        # then a mark. The first edge is the middle of the start bit (always 1).
+        h = 1  # Half bit being read, odd halves give the bit value
+        bits = 0
+        nbits = 0
+        for k in range(self.edge - 1):
+            width = ticks_diff(self._times[k + 1], self._times[k])
+            if width > 3 * threshold // 2:
+                return _BADDATA
+            n = 1 if width < threshold else 2
+            for _ in range(n):
+                if h & 1:
+                    # Intervals starting on even edges are marks
+                    bits = (bits << 1) | (0 if k & 1 else 1)
+                    nbits += 1
+                h += 1
+        if h & 1:  # Trailing space is the second half of a 0
+            bits <<= 1
+            nbits += 1
+        if nbits != 14:
+            return _BADBLOCK
+        self._rc5_addr = (bits >> 6) & 0x1f
+        self._rc5_toggle = (bits >> 11) & 1
+        cmd = bits & 0x3f
+        if not (bits >> 12) & 1:  # Inverted field bit is command bit 6 (RC5X)
+            cmd |= 0x40
+        return cmd
 
     def _print_raw(self):
         lb = self.edge - 1  # Possible length of burst
@@ -149,24 +328,45 @@ class IR_RX():
     
     def do_callback(self, cmd, addr, ext, thresh=0):
         self.edge = 0
+        self._done = False
         if cmd >= thresh:
             if cmd < 0:  # NEC protocol sends repeat codes.
-                #self._raw_code = 'Repeat code'
                 if self.verbose:
                     print('Repeat code.')
                 #keep data old
-                self._key_pressed = self._last_key_pressed
+                key = self._last_key_pressed
+                kind = IR_HOLD if self._held else IR_PRESS
             else:
-                self._raw_code = 'Data: {:d}, Addr: {:d}'.format(cmd, addr)
+                self._raw_state = _RAW_DATA
+                self._raw_cmd = cmd
+                self._raw_addr = addr
                 if self.verbose:
-                    print(self._raw_code)
-                self._key_pressed = cmd
-                self._last_key_pressed = self._key_pressed
+                    print(self.get_raw_code())
+                key = cmd
+                if self._held:  # a new frame ends the previous press
+                    self._release()
+                kind = IR_PRESS
 
-            if self._callback:
-                self._callback(self._key_pressed, addr, ext)
+            if key is not None:
+                self._key_pressed = key
+                self._last_key_pressed = key
+                self._held = True
+                self._held_addr = addr
+                now = ticks_ms()
+                if kind == IR_PRESS or ticks_diff(now, self._hold_ticks) >= self.hold_repeat_ms:
+                    self._hold_ticks = now
+                    self._push_event(key, addr, kind)
+                    if self._callback:
+                        # run the user code outside of the timer callback
+                        self._frame[0] = key
+                        self._frame[1] = addr
+                        self._frame[2] = ext
+                        try:
+                            schedule(self._run_callback_ref, 0)
+                        except RuntimeError:
+                            pass
         else:
-            self._raw_code = 'Unsupported code'
+            self._raw_state = _RAW_UNSUPPORTED
             if self.verbose:
                 if cmd in _errors:
                     print(_errors[cmd])
@@ -176,7 +376,84 @@ class IR_RX():
             #self._key_pressed = None
             #self._last_key_pressed = None
             if self._error_callback:
-                self._error_callback(cmd)
+                self._frame[4] = cmd
+                try:
+                    schedule(self._run_error_callback_ref, 0)
+                except RuntimeError:
+                    pass
+
+        # Released if no frame starts within release_ms, the first edge of the
+        # next frame restarts the timer as block timer. Also after an error,
+        # as the noise that caused it took the timer over.
+        if self._held:
+            self._tim.init(period=self.release_ms, mode=Timer.ONE_SHOT, callback=self._release_ref)
+
+    def _release_timeout(self, _):
+        if self._held and not self.edge:
+            self._release()
+
+    def _release(self):
+        self._held = False
+        key = self._key_pressed
+        self._key_pressed = None
+        if key is None:
+            return
+        self._push_event(key, self._held_addr, IR_RELEASE)
+        if self._release_callback:
+            self._frame[3] = key
+            try:
+                schedule(self._run_release_callback_ref, 0)
+            except RuntimeError:
+                pass
+
+    def _push_event(self, cmd, addr, kind):
+        size = len(self._events) // 4
+        n = self._event_in
+        if (n - self._event_out) % self._event_wrap >= size:
+            # full: the oldest event is overwritten, read_event() skips it
+            self.overflows += 1
+        i = (n % size) * 4
+        self._events[i] = cmd
+        self._events[i + 1] = addr
+        self._events[i + 2] = ticks_ms()
+        self._events[i + 3] = kind
+        self._event_in = (n + 1) % self._event_wrap
+
+    def available(self):
+        """Number of events waiting in the queue"""
+        return min((self._event_in - self._event_out) % self._event_wrap, len(self._events) // 4)
+
+    def read_event(self):
+        """Pop the oldest (cmd, addr, ticks_ms, kind) event, None if empty.
+        kind is IR_PRESS, IR_HOLD (repeat while held) or IR_RELEASE."""
+        size = len(self._events) // 4
+        out = self._event_out
+        while True:
+            pending = (self._event_in - out) % self._event_wrap
+            if not pending:
+                return None
+            if pending > size:
+                # overwritten while full, skip to the oldest one left
+                out = (self._event_in - size) % self._event_wrap
+            i = (out % size) * 4
+            event = (self._events[i], self._events[i + 1], self._events[i + 2], self._events[i + 3])
+            # an event pushed meanwhile may have overwritten this slot
+            if (self._event_in - out) % self._event_wrap <= size:
+                break
+        self._event_out = (out + 1) % self._event_wrap
+        return event
+
+    def _run_callback(self, _):
+        if self._callback:
+            self._callback(self._frame[0], self._frame[1], self._frame[2])
+
+    def _run_release_callback(self, _):
+        if self._release_callback:
+            self._release_callback(self._frame[3])
+
+    def _run_error_callback(self, _):
+        if self._error_callback:
+            self._error_callback(self._frame[4])
 
     def on_received(self, cb):
         self._callback = cb
@@ -184,22 +461,47 @@ class IR_RX():
     def on_error(self, cb):
         self._error_callback = cb
 
+    def on_release(self, cb):
+        self._release_callback = cb
+
+    def repeat(self, release_ms=None, hold_repeat_ms=None):
+        """Set how long without frames releases a held key, and the minimum
+        time between two hold events. Returns (release_ms, hold_repeat_ms)
+        when called without arguments."""
+        if release_ms is None and hold_repeat_ms is None:
+            return self.release_ms, self.hold_repeat_ms
+        if release_ms is not None:
+            self.release_ms = release_ms
+        if hold_repeat_ms is not None:
+            self.hold_repeat_ms = hold_repeat_ms
+
     def get_code(self):
+        """Key being held, None once it is released"""
         return self._key_pressed
     
+    def get_protocol(self):
+        return self._protocol
+
     def get_raw_code(self):
-        return self._raw_code
+        if self._raw_state == _RAW_DATA:
+            return 'Data: {:d}, Addr: {:d}'.format(self._raw_cmd, self._raw_addr)
+        if self._raw_state == _RAW_UNSUPPORTED:
+            return 'Unsupported code'
+        return None
     
     def clear_code(self):
-        self._raw_code = None
+        # a frame decoded in between only sets the key again, as if it came
+        # right after the clear
+        self._raw_state = _RAW_NONE
         self._key_pressed = None
 
     def start(self):
         self.stop()
         self._pin.irq(handler = self._cb_pin, trigger = (Pin.IRQ_FALLING | Pin.IRQ_RISING))
-        self._tim = Timer(3)  # Sofware timer
+        self._tim = claim_timer(self._timer_id, self)
     
     def stop(self):
         self._pin.irq(handler = None)
         if self._tim:
             self._tim.deinit()
+            release_timer(self._timer_id, self)
@@ -0,0 +1,25 @@
+class Lazy:
+    """
+    Stand-in for a module level singleton. The object is built by factory()
+    on first attribute access, so importing a module costs nothing for the
+    hardware a program does not use.
+    Reading and assigning attributes through the proxy both reach the object.
+    """
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None)
+
+    def _get(self):
+        if self._obj is None:
+            object.__setattr__(self, '_obj', self._factory())
+        return self._obj
+
+    def __getattr__(self, name):
+        # only called for names the proxy itself does not have
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name, value):
+        if name in ('_factory', '_obj'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._get(), name, value)
@@ -1,33 +1,167 @@
 import machine
-from machine import Pin
+from machine import Pin, Timer
+from micropython import schedule
+from makerbit_timers import claim_timer, release_timer
 
 S1_IN_S2_OUT = const(0)
 S1_OUT_S2_IN = const(1)
 S1_OUT_S2_OUT = const(2)
 S1_IN_S2_IN = const(3)
 
+# state for (left << 1 | right) pin values
+_STATES = bytes((S1_OUT_S2_OUT, S1_OUT_S2_IN, S1_IN_S2_OUT, S1_IN_S2_IN))
+
 class LineFinder:
-    def __init__(self, sig_1, sig_2):
+    def __init__(self, sig_1, sig_2, irq=False):
         self.sig_1 = sig_1
         self.sig_2 = sig_2
         self.left_pin = Pin(sig_1, mode=Pin.IN, pull=None)
         self.right_pin = Pin(sig_2, mode=Pin.IN, pull=None)
+        self._irq = False
+        self._callback = None
+        self._state = self._sample()
+        if irq:
+            self.irq(True)
+
+    def _sample(self):
+        # both sensors read once, back to back
+        return _STATES[(self.left_pin.value() << 1) | self.right_pin.value()]
 
     def read(self):
-        if self.left_pin.value() and not self.right_pin.value():
-            # detect line on left side
-            return S1_IN_S2_OUT
-        elif not self.left_pin.value() and self.right_pin.value():
-            # detect line on right side
-            return S1_OUT_S2_IN
-        elif not self.left_pin.value() and not self.right_pin.value():
-            # detect line on none side
-            return S1_OUT_S2_OUT
-        elif self.left_pin.value() and self.right_pin.value():
-            # detect line on both side
-            return S1_IN_S2_IN
+        if self._irq:
+            # kept up to date by the pin interrupts
+            return self._state
+        return self._sample()
+
+    def irq(self, value=None):
+        """
+        Enable or disable pin change interrupts. When enabled, read() returns
+        the state stored by the interrupts without touching the pins.
+        """
+        if value is None:
+            return self._irq
+        value = bool(value)
+        if self._irq == value:
+            return
+        self._irq = value
+        if value:
+            self._state = self._sample()
+            trigger = Pin.IRQ_FALLING | Pin.IRQ_RISING
+            self.left_pin.irq(handler=self._cb_pin, trigger=trigger)
+            self.right_pin.irq(handler=self._cb_pin, trigger=trigger)
         else:
-            # detect error
+            self.left_pin.irq(handler=None)
+            self.right_pin.irq(handler=None)
+
+    def on_change(self, callback):
+        """
+        Call callback(state) whenever the state changes, interrupts are
+        enabled if needed
+        """
+        self._callback = callback
+        self.irq(True)
+
+    def _cb_pin(self, pin):
+        state = self._sample()
+        if state != self._state:
+            self._state = state
+            if self._callback:
+                try:
+                    schedule(self._callback, state)
+                except RuntimeError:
+                    pass
+
+
+class LineFollower:
+    """
+    Follow a line with a LineFinder and DCMotors from a timer, so the loop
+    timing does not depend on the rest of the program.
+    The sensor state is turned into an error (-1 line on the left, +1 line on
+    the right) and a PID controller sets both wheel speeds in one write.
+    """
+    def __init__(self, line_finder, motor, speed=40, kp=25, ki=0, kd=10,
+                 rate=100, line_between=False, timer_id=2):
+        """
+        line_finder: LineFinder instance
+        motor: DCMotors instance (makerbit.motor)
+        speed: Base speed of both wheels, 0-100
+        kp, ki, kd: PID gains, in wheel speed per unit of error (ki per
+        second of error, kd per change of error between two steps)
+        rate: Control loop frequency in Hz
+        line_between: True if the line runs between the two sensors, so no
+        sensor on the line means centered
+        timer_id: Hardware timer used for the control loop, see makerbit_timers
+        """
+        self.line_finder = line_finder
+        self.motor = motor
+        self.speed = speed
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.rate = rate
+        self.line_between = line_between
+        self._timer_id = timer_id
+        self._timer = None
+        self._step_ref = self._step # bound once, used from the timer
+        self._reset()
+
+    def _reset(self):
+        self._integral = 0
+        self._last_error = 0
+        self._last_side = 0
+
+    def tune(self, kp=None, ki=None, kd=None):
+        if kp is not None:
+            self.kp = kp
+        if ki is not None:
+            self.ki = ki
+        if kd is not None:
+            self.kd = kd
+
+    def start(self):
+        self.stop()
+        self._reset()
+        self._timer = claim_timer(self._timer_id, self)
+        self._timer.init(period=max(1, int(1000 / self.rate)), mode=Timer.PERIODIC,
+            callback=self._timer_cb)
+
+    def stop(self):
+        if self._timer:
+            self._timer.deinit()
+            self._timer = None
+            release_timer(self._timer_id, self)
+            self.motor.stop()
+
+    def running(self):
+        return self._timer is not None
+
+    def _timer_cb(self, _):
+        # the motors are driven over I2C, not allowed in a hard interrupt
+        try:
+            schedule(self._step_ref, 0)
+        except RuntimeError:
+            pass
+
+    def _error(self, state):
+        if state == S1_IN_S2_OUT:
             return -1
+        if state == S1_OUT_S2_IN:
+            return 1
+        if state == S1_IN_S2_IN or self.line_between:
+            return 0
+        # line lost: keep turning to the side it was last seen on
+        return 2 * self._last_side
 
-line_finder = LineFinder()
\ No newline at end of file
+    def _step(self, _):
+        if self._timer is None:
+            return
+        error = self._error(self.line_finder.read())
+        if error:
+            self._last_side = 1 if error > 0 else -1
+        self._integral = max(-100, min(100, self._integral + error / self.rate))
+        correction = self.kp * error + self.ki * self._integral + \
+            self.kd * (error - self._last_error)
+        self._last_error = error
+        left = max(-100, min(100, self.speed + correction))
+        right = max(-100, min(100, self.speed - correction))
+        self.motor.set_wheel_speed(left, right)
@@ -1,14 +1,24 @@
 import time
 import math
-from micropython import const
-from machine import Pin, I2C
+import ustruct
+import ujson
+from array import array
+from micropython import const, schedule
+from machine import Pin, I2C, Timer
+from makerbit_i2c import get_i2c
+from makerbit_lazy import Lazy
+from makerbit_timers import claim_timer, release_timer
 
 PWR_MGMT_1   = const(0x6B)
 SMPLRT_DIV   = const(0x19)
 CONFIG       = const(0x1A)
 GYRO_CONFIG  = const(0x1B)
 ACCEL_CONFIG = const(0x1C)
+MOT_THR      = const(0x1F)
+MOT_DUR      = const(0x20)
+INT_PIN_CFG  = const(0x37)
 INT_ENABLE   = const(0x38)
+INT_STATUS   = const(0x3A)
 ACCEL_XOUT_H = const(0x3B)
 ACCEL_YOUT_H = const(0x3D)
 ACCEL_ZOUT_H = const(0x3F)
@@ -16,12 +26,72 @@ GYRO_XOUT_H  = const(0x43)
 GYRO_YOUT_H  = const(0x45)
 GYRO_ZOUT_H  = const(0x47)
 TEMP_OUT_H   = const(0X41)
+FIFO_EN      = const(0x23)
+USER_CTRL    = const(0x6A)
+FIFO_COUNTH  = const(0x72)
+FIFO_R_W     = const(0x74)
+
+_FIFO_SIZE   = const(1024)
+_FIFO_SAMPLE = const(12) # AcX, AcY, AcZ, GyX, GyY, GyZ
+_FIFO_BURST  = const(32) # samples drained per I2C read
+
+_DEG2RAD = math.pi / 180
+_RAD2DEG = 180 / math.pi
+
+_CALIBRATION_FILE = 'motion_calibration.json'
+_CALIBRATION_KEYS = ('gyroXoffs', 'gyroYoffs', 'gyroZoffs', 'acXoffs', 'acYoffs',
+    'acZoffs', 'gyroZoffs_min', 'gyroZoffs_max')
+
+_REGISTERS = {
+    'AcX': ACCEL_XOUT_H,
+    'AcY': ACCEL_YOUT_H,
+    'AcZ': ACCEL_ZOUT_H,
+    'GyX': GYRO_XOUT_H,
+    'GyY': GYRO_YOUT_H,
+    'GyZ': GYRO_ZOUT_H,
+}
 
 class Motion:
     def __init__(self, i2c, address=0x68):
         self._i2c = i2c
         self._addr = address
 
+        # preallocated buffers so sampling does not allocate
+        self.__buf = bytearray(14)
+        self.__buf2 = bytearray(2)
+        self.__sums = array('i', [0] * 6) # AcX, AcY, AcZ, GyX, GyY, GyZ
+        self.__vals = array('f', [0] * 6)
+        # second set for the sampler, which can run in the middle of a read
+        self.__sbuf = bytearray(14)
+        self.__sbuf2 = bytearray(2)
+        self.__ssums = array('i', [0] * 6)
+        self.__svals = array('f', [0] * 6)
+        self.__fifo_buf = None
+
+        self._fifo = False
+        self.fifo_rate = 0
+        self.fifo_overflows = 0
+
+        self._fusion = 'complementary'
+        self.__beta = 0.1
+        self.__q0 = 1.0
+        self.__q1 = self.__q2 = self.__q3 = 0.0
+        self.__yaw = 0.0
+
+        self._shake_event = False
+        self._shaked = False
+        self._shake_pin = None
+        self._shake_callback = None
+        self.__shake_ref = self.__shake_handler # bound once, used from the IRQ
+
+        self._sampler = None
+        self._sampler_z_only = False
+        self.__sample_ref = self.__sample # bound once, used from the timer
+        self.__history = None
+        self.__history_head = 0
+        self.__history_count = 0
+        self.sampler_missed = 0
+
         #Close the sleep mode
         #Write to power management register to wake up mpu6050
         self.__register(PWR_MGMT_1, 0)
@@ -62,7 +132,8 @@ class Motion:
         self.scaleFactorGyro = scale * 1.0 / 32768.0
 
         # #set the accelerometer scale to 4g: 2g (16384)--> 0x00, 4g (8192)--> 0x08, 8g (4096) --> 0x10, 16g (2048)--> 0x18
-        x = self.__read_raw_data(ACCEL_CONFIG, 1)        
+        # ignore the high pass filter bits used by the shake event
+        x = bytes([self.__read_raw_data(ACCEL_CONFIG, 1)[0] & 0x18])
         if x == b'\x00':
             scale = 2
         elif x == b'\x08':
@@ -75,85 +146,131 @@ class Motion:
         self.scaleFactorAccel = scale * 1.0 / 32768.0
 
     def __register(self, reg, data): #Write the registor of i2c device.
-        self._i2c.start()
+        # no explicit start()/stop(): hardware I2C buses do not support them
         self._i2c.writeto(self._addr, bytearray([reg, data]))
-        self._i2c.stop()
-
-    def __bytes_toint(self, firstbyte, secondbyte):
-        if not firstbyte & 0x80:
-            return firstbyte << 8 | secondbyte
-        return - (((firstbyte ^ 255) << 8) | (secondbyte ^ 255) + 1)
 
     def __read_raw_data(self, addr, size):
+        a = [0] * size
         try:
-            self._i2c.start()
-            a = [0] * size
             a = self._i2c.readfrom_mem(self._addr, addr, size)
         finally:
-            self._i2c.stop()
             return a
 
     def __get_raw_value(self, name=None):
         if name == None:
-            raw_ints = self.__read_raw_data(ACCEL_XOUT_H, 14)
-            vals = {}
-            vals["AcX"] = self.__bytes_toint(raw_ints[0], raw_ints[1])
-            vals["AcY"] = self.__bytes_toint(raw_ints[2], raw_ints[3])
-            vals["AcZ"] = self.__bytes_toint(raw_ints[4], raw_ints[5])
-            vals["Tmp"] = self.__bytes_toint(raw_ints[6], raw_ints[7]) / 340.00 + 36.53
-            vals["GyX"] = self.__bytes_toint(raw_ints[8], raw_ints[9])
-            vals["GyY"] = self.__bytes_toint(raw_ints[10], raw_ints[11])
-            vals["GyZ"] = self.__bytes_toint(raw_ints[12], raw_ints[13])
-            return vals
-
-        a = [0,0]
-        if (name == 'GyZ'):
-            a = self.__read_raw_data(GYRO_ZOUT_H, 2)
-        elif name == 'GyY':
-            a = self.__read_raw_data(GYRO_YOUT_H, 2)
-        elif name == 'GyX':
-            a = self.__read_raw_data(GYRO_XOUT_H, 2)
-        elif name == 'AcX':
-            a = self.__read_raw_data(ACCEL_XOUT_H, 2)
-        elif name == 'AcY':
-            a = self.__read_raw_data(ACCEL_YOUT_H, 2)
-        elif name == 'AcZ':
-            a = self.__read_raw_data(ACCEL_ZOUT_H, 2)
-        return self.__bytes_toint(a[0], a[1])
-    
+            # one 14 bytes burst: AcX, AcY, AcZ, Tmp, GyX, GyY, GyZ
+            self._i2c.readfrom_mem_into(self._addr, ACCEL_XOUT_H, self.__buf)
+            return ustruct.unpack_from('>7h', self.__buf)
+
+        self._i2c.readfrom_mem_into(self._addr, _REGISTERS[name], self.__buf2)
+        return ustruct.unpack_from('>h', self.__buf2)[0]
+
     def __get_value(self, name=None, n_samples=1, sleep=0):
         try:
             result = 0
             if name == None:
-                vals = {}
-                vals['AcX'] = vals['AcY'] = vals['AcZ'] = vals['GyX'] = vals['GyY'] = vals['GyZ'] = 0.0 
+                sums = self.__sums
+                for i in range(6):
+                    sums[i] = 0
                 for i in range(n_samples):
-                    data = self.__get_raw_value()
-                    vals['AcX'] += data['AcX'] * self.scaleFactorAccel / n_samples
-                    vals['AcY'] += data['AcY'] * self.scaleFactorAccel / n_samples
-                    vals['AcZ'] += data['AcZ'] * self.scaleFactorAccel / n_samples
-                    vals['GyX'] += data['GyX'] * self.scaleFactorGyro / n_samples
-                    vals['GyY'] += data['GyY'] * self.scaleFactorGyro / n_samples
-                    vals['GyZ'] += data['GyZ'] * self.scaleFactorGyro / n_samples
+                    acx, acy, acz, _, gyx, gyy, gyz = self.__get_raw_value()
+                    sums[0] += acx
+                    sums[1] += acy
+                    sums[2] += acz
+                    sums[3] += gyx
+                    sums[4] += gyy
+                    sums[5] += gyz
                     if sleep:
                         time.sleep_ms(sleep)
+                # returns a reused array: AcX, AcY, AcZ, GyX, GyY, GyZ
+                vals = self.__vals
+                accel = self.scaleFactorAccel / n_samples
+                gyro = self.scaleFactorGyro / n_samples
+                for i in range(3):
+                    vals[i] = sums[i] * accel
+                    vals[i + 3] = sums[i + 3] * gyro
                 result = vals
             else:
-                val = 0.0
+                val = 0
                 for i in range(n_samples):
-                    val += self.__get_raw_value(name) / n_samples
+                    val += self.__get_raw_value(name)
                     if sleep:
                         time.sleep_ms(sleep)
 
                 if name == 'AcX' or name == 'AcY' or name == 'AcZ':
-                    val = val * self.scaleFactorAccel
+                    val = val * self.scaleFactorAccel / n_samples
                 else:
-                    val = val * self.scaleFactorGyro
+                    val = val * self.scaleFactorGyro / n_samples
 
                 result = val
         finally:
             return result
 
+    def start_fifo(self, rate=200):
+        """Stream accel and gyro samples through the FIFO at a fixed rate (Hz).
+        update() and updateZ() then integrate every queued sample.
+        """
+        # with the low pass filter on the gyro output rate is 1kHz
+        div = max(0, min(255, int(1000 / rate + 0.5) - 1))
+        self.fifo_rate = 1000 / (div + 1)
+        self.__register(SMPLRT_DIV, div)
+        if self.__fifo_buf is None:
+            self.__fifo_buf = bytearray(_FIFO_BURST * _FIFO_SAMPLE)
+        self.__register(FIFO_EN, 0)
+        self.__register(USER_CTRL, 0x04) # FIFO reset
+        self.__register(FIFO_EN, 0x78) # XG, YG, ZG and ACCEL
+        self.__register(USER_CTRL, 0x40) # FIFO enable
+        self._fifo = True
+
+    def stop_fifo(self):
+        self.__register(FIFO_EN, 0)
+        self.__register(USER_CTRL, 0x04) # FIFO reset
+        self._fifo = False
+        self.update_time = time.time_ns()
+
+    def fifo_count(self):
+        """Number of complete samples waiting in the FIFO"""
+        self._i2c.readfrom_mem_into(self._addr, FIFO_COUNTH, self.__buf2)
+        count = ustruct.unpack_from('>H', self.__buf2)[0]
+        if count > _FIFO_SIZE - _FIFO_SAMPLE:
+            # overflowed, samples are no longer aligned
+            self.fifo_overflows += 1
+            self.__register(USER_CTRL, 0x44) # FIFO enable and reset
+            return 0
+        return count // _FIFO_SAMPLE
+
+    def __fifo_burst(self, n):
+        n = min(n, _FIFO_BURST)
+        self._i2c.readfrom_mem_into(self._addr, FIFO_R_W,
+            memoryview(self.__fifo_buf)[:n * _FIFO_SAMPLE])
+        return n
+
+    def fifo_samples(self, max_samples=None):
+        """Generator draining the samples queued when it starts, in bursts.
+        Yields raw (AcX, AcY, AcZ, GyX, GyY, GyZ) tuples."""
+        left = self.fifo_count()
+        if max_samples is not None:
+            left = min(left, max_samples)
+        while left > 0:
+            n = self.__fifo_burst(left)
+            for i in range(n):
+                yield ustruct.unpack_from('>6h', self.__fifo_buf, i * _FIFO_SAMPLE)
+            left -= n
+
+    def read_fifo(self, buf):
+        """Drain up to len(buf) // 6 samples into buf, an array('h'), as raw
+        AcX, AcY, AcZ, GyX, GyY, GyZ values. Returns the number of samples."""
+        total = min(self.fifo_count(), len(buf) // 6)
+        n = 0
+        while n < total:
+            count = self.__fifo_burst(total - n)
+            for i in range(count):
+                j = (n + i) * 6
+                buf[j], buf[j + 1], buf[j + 2], buf[j + 3], buf[j + 4], buf[j + 5] = \
+                    ustruct.unpack_from('>6h', self.__fifo_buf, i * _FIFO_SAMPLE)
+            n += count
+        return n
+
     def begin(self):
         self.angleX = 0.0
         self.angleY = 0.0
@@ -162,21 +279,29 @@ class Motion:
     
     def calibrateZ(self, n_samples=2000): #calibrate for Z axis
         # print("Calib...") #TODO
-        val = self.__get_raw_value('GyZ') * self.scaleFactorGyro
-        self.gyroZoffs_min = self.gyroZoffs_max = val
-        self.gyroZoffs = val
-        Zoffs = val / n_samples
+        # accumulate raw integers, scale once at the end
+        val = self.__get_raw_value('GyZ')
+        val_min = val_max = Zoffs = val
         for _ in range(n_samples - 1):
-            val = self.__get_raw_value('GyZ') * self.scaleFactorGyro
-            if self.gyroZoffs_min > val:
-                self.gyroZoffs_min = val
-            if self.gyroZoffs_max < val:
-                self.gyroZoffs_max = val
-            Zoffs += val / n_samples
-        self.gyroZoffs = Zoffs
+            val = self.__get_raw_value('GyZ')
+            if val_min > val:
+                val_min = val
+            if val_max < val:
+                val_max = val
+            Zoffs += val
+        self.gyroZoffs_min = val_min * self.scaleFactorGyro
+        self.gyroZoffs_max = val_max * self.scaleFactorGyro
+        self.gyroZoffs = Zoffs * self.scaleFactorGyro / n_samples
         # print("...done") #TODO
         
     def updateZ(self):
+        if self._fifo:
+            deltaT = 1 / self.fifo_rate
+            scale = self.scaleFactorGyro
+            for sample in self.fifo_samples():
+                self.angleZ += (sample[5] * scale - self.gyroZoffs) * deltaT
+            self.update_time = time.time_ns()
+            return
         t_now = time.time_ns()
         gyrZ = self.__get_value('GyZ') - self.gyroZoffs
         deltaT = (t_now - self.update_time) * 1e-9
@@ -185,30 +310,137 @@ class Motion:
 
     def calibrate(self, n_samples=1000, sleep=0): #calibrate for all axis
         data = self.__get_value(None, n_samples, sleep)
-        self.acXoffs = data['AcX']
-        self.acYoffs = data['AcY']
-        self.acZoffs = data['AcZ']
-        self.gyroXoffs = data['GyX']
-        self.gyroYoffs = data['GyY']
-        self.gyroZoffs = data['GyZ']
+        self.acXoffs = data[0]
+        self.acYoffs = data[1]
+        self.acZoffs = data[2]
+        self.gyroXoffs = data[3]
+        self.gyroYoffs = data[4]
+        self.gyroZoffs = data[5]
+
+    def save_calibration(self, path=_CALIBRATION_FILE):
+        """Store the offsets and the scale configuration they belong to"""
+        data = {
+            'gyro_config': self.__read_raw_data(GYRO_CONFIG, 1)[0],
+            'accel_config': self.__read_raw_data(ACCEL_CONFIG, 1)[0] & 0x18,
+        }
+        for key in _CALIBRATION_KEYS:
+            if hasattr(self, key):
+                data[key] = getattr(self, key)
+        with open(path, 'w') as f:
+            ujson.dump(data, f)
+
+    def load_calibration(self, path=_CALIBRATION_FILE):
+        """Load offsets saved by save_calibration(). Returns False if there
+        is no file or it was made with another scale configuration."""
+        try:
+            with open(path) as f:
+                data = ujson.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('gyro_config') != self.__read_raw_data(GYRO_CONFIG, 1)[0] or \
+                data.get('accel_config') != self.__read_raw_data(ACCEL_CONFIG, 1)[0] & 0x18:
+            return False
+        for key in _CALIBRATION_KEYS:
+            if key in data:
+                setattr(self, key, data[key])
+        return True
+
+    def calibrate_cached(self, n_samples=1000, z_only=False, check_samples=50,
+            tolerance=1.0, path=_CALIBRATION_FILE):
+        """Load the stored calibration instead of recalibrating at every boot.
+        A short check (check_samples reads) compares the current gyro bias
+        with the stored one. When the robot is still and the bias moved more
+        than tolerance (deg/s), the offsets are moved halfway to the new
+        estimate and saved again. Without stored data a full calibrate() (or
+        calibrateZ() if z_only) is run and saved.
+        """
+        if not self.load_calibration(path):
+            if z_only:
+                self.calibrateZ(n_samples)
+            else:
+                self.calibrate(n_samples)
+            self.save_calibration(path)
+            return
+
+        sums = [0, 0, 0]
+        mins = [32767] * 3
+        maxs = [-32768] * 3
+        for _ in range(check_samples):
+            raw = self.__get_raw_value()
+            for i in range(3):
+                val = raw[i + 4]
+                sums[i] += val
+                if mins[i] > val:
+                    mins[i] = val
+                if maxs[i] < val:
+                    maxs[i] = val
+
+        scale = self.scaleFactorGyro
+        for i in range(3):
+            if (maxs[i] - mins[i]) * scale > 4 * tolerance:
+                return # moving, keep the stored offsets
+
+        offsets = ('gyroXoffs', 'gyroYoffs', 'gyroZoffs')
+        stale = False
+        for i in range(3):
+            if z_only and i < 2:
+                continue
+            bias = sums[i] * scale / check_samples
+            offs = getattr(self, offsets[i])
+            if abs(bias - offs) > tolerance:
+                setattr(self, offsets[i], (offs + bias) / 2)
+                stale = True
+        if stale:
+            self.save_calibration(path)
 
     def update(self):
         #The accelerometer data is reliable only on the long term, so a "low pass" filter has to be used.
         #The gyroscope data is reliable only on the short term, as it starts to drift on the long term.
+        if self._fifo:
+            # fixed sample spacing, no dependency on when update() is called
+            deltaT = 1 / self.fifo_rate
+            accel = self.scaleFactorAccel
+            gyro = self.scaleFactorGyro
+            for acx, acy, acz, gyx, gyy, gyz in self.fifo_samples():
+                self.fuse(acx * accel, acy * accel, acz * accel,
+                    gyx * gyro - self.gyroXoffs, gyy * gyro - self.gyroYoffs,
+                    gyz * gyro - self.gyroZoffs, deltaT)
+            self.update_time = time.time_ns()
+            return
+
         t_now = time.time_ns()
         data = self.__get_value()
-        accX = data['AcX']
-        accY = data['AcY']
-        accZ = data['AcZ']
-        gyrX = data['GyX'] - self.gyroXoffs
-        gyrY = data['GyY'] - self.gyroYoffs
-        gyrZ = data['GyZ'] - self.gyroZoffs
+        deltaT = (t_now - self.update_time) * 1e-9
+        self.update_time = t_now
+        self.fuse(data[0], data[1], data[2], data[3] - self.gyroXoffs,
+            data[4] - self.gyroYoffs, data[5] - self.gyroZoffs, deltaT)
+
+    def fusion(self, engine=None, beta=0.1):
+        """Select the sensor fusion engine used by update():
+        'complementary' (default, per axis) or 'madgwick' (quaternion,
+        beta is the accelerometer correction gain)"""
+        if engine is None:
+            return self._fusion
+        if engine not in ('complementary', 'madgwick'):
+            raise ValueError("engine must be 'complementary' or 'madgwick'")
+        self._fusion = engine
+        self.__beta = beta
+        self.__q0 = 1.0
+        self.__q1 = self.__q2 = self.__q3 = 0.0
+        self.__yaw = 0.0
+
+    def fuse(self, accX, accY, accZ, gyrX, gyrY, gyrZ, deltaT):
+        """Run one fusion step on a sample in g and deg/s (gyro offsets
+        already removed). update() calls it, it can also replay recorded
+        samples to compare the engines."""
+        if self._fusion == 'madgwick':
+            self.__madgwick(accX, accY, accZ, gyrX, gyrY, gyrZ, deltaT)
+        else:
+            self.__complementary(accX, accY, accZ, gyrX, gyrY, gyrZ, deltaT)
 
+    def __complementary(self, accX, accY, accZ, gyrX, gyrY, gyrZ, deltaT):
         ax = math.atan2(accX, math.sqrt( math.pow(accY, 2) + math.pow(accZ, 2) ) ) * 180 / 3.1415926
         ay = math.atan2(accY, math.sqrt( math.pow(accX, 2) + math.pow(accZ, 2) ) ) * 180 / 3.1415926
-        
-        deltaT = (t_now - self.update_time) * 1e-9
-        self.update_time = t_now
 
         if accZ > 0:
           self.angleX -= gyrY * deltaT
@@ -226,6 +458,162 @@ class Motion:
         self.angleX = self.angleX * filter_coefficient + ax * (1 - filter_coefficient)
         self.angleY = self.angleY * filter_coefficient + ay * (1 - filter_coefficient)
 
+    def __madgwick(self, ax, ay, az, gx, gy, gz, deltaT):
+        # Madgwick IMU filter, see "An efficient orientation filter for
+        # inertial and inertial/magnetic sensor arrays" (S. Madgwick, 2010)
+        q0 = self.__q0
+        q1 = self.__q1
+        q2 = self.__q2
+        q3 = self.__q3
+        gx *= _DEG2RAD
+        gy *= _DEG2RAD
+        gz *= _DEG2RAD
+
+        # rate of change of quaternion from gyroscope
+        qDot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qDot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qDot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qDot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        norm = ax * ax + ay * ay + az * az
+        if norm > 0:
+            norm = 1 / math.sqrt(norm)
+            ax *= norm
+            ay *= norm
+            az *= norm
+
+            # gradient descent corrective step
+            _2q0 = 2 * q0
+            _2q1 = 2 * q1
+            _2q2 = 2 * q2
+            _2q3 = 2 * q3
+            _4q0 = 4 * q0
+            _4q1 = 4 * q1
+            _4q2 = 4 * q2
+            _8q1 = 8 * q1
+            _8q2 = 8 * q2
+            q0q0 = q0 * q0
+            q1q1 = q1 * q1
+            q2q2 = q2 * q2
+            q3q3 = q3 * q3
+            s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+            s1 = _4q1 * q3q3 - _2q3 * ax + 4 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+            s2 = 4 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+            s3 = 4 * q1q1 * q3 - _2q1 * ax + 4 * q2q2 * q3 - _2q2 * ay
+            norm = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+            if norm > 0:
+                norm = self.__beta / math.sqrt(norm)
+                qDot0 -= s0 * norm
+                qDot1 -= s1 * norm
+                qDot2 -= s2 * norm
+                qDot3 -= s3 * norm
+
+        q0 += qDot0 * deltaT
+        q1 += qDot1 * deltaT
+        q2 += qDot2 * deltaT
+        q3 += qDot3 * deltaT
+        norm = 1 / math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        q0 *= norm
+        q1 *= norm
+        q2 *= norm
+        q3 *= norm
+        self.__q0 = q0
+        self.__q1 = q1
+        self.__q2 = q2
+        self.__q3 = q3
+
+        # same axes and signs as the complementary filter
+        self.angleX = math.asin(max(-1, min(1, 2 * (q1 * q3 - q0 * q2)))) * _RAD2DEG
+        self.angleY = math.atan2(q0 * q1 + q2 * q3, 0.5 - q1 * q1 - q2 * q2) * _RAD2DEG
+        # angleZ is not wrapped, accumulate the change of yaw
+        yaw = math.atan2(q1 * q2 + q0 * q3, 0.5 - q2 * q2 - q3 * q3) * _RAD2DEG
+        change = yaw - self.__yaw
+        if change > 180:
+            change -= 360
+        elif change < -180:
+            change += 360
+        self.__yaw = yaw
+        self.angleZ += change
+
+    def start_sampler(self, rate=100, history=32, z_only=False, timer_id=2):
+        """Run update() (or updateZ() if z_only) from a timer at a fixed rate
+        (Hz) so angles keep integrating while the main loop blocks. The last
+        `history` (angleX, angleY, angleZ) samples are kept in a ring buffer.
+        """
+        if not hasattr(self, 'angleZ'):
+            self.begin()
+        self.stop_sampler()
+        if history:
+            self.__history = array('f', [0] * (history * 3))
+        else:
+            self.__history = None
+        self.__history_head = self.__history_count = 0
+        self._sampler_z_only = z_only
+        self.update_time = time.time_ns()
+        self._sampler = claim_timer(timer_id, self)
+        self._sampler_id = timer_id
+        self._sampler.init(period=max(1, int(1000 / rate)), mode=Timer.PERIODIC,
+            callback=self.__sampler_cb)
+
+    def stop_sampler(self):
+        if self._sampler:
+            self._sampler.deinit()
+            self._sampler = None
+            release_timer(self._sampler_id, self)
+
+    def __sampler_cb(self, _):
+        # I2C is not allowed in a hard interrupt, do the work from the scheduler
+        try:
+            schedule(self.__sample_ref, 0)
+        except RuntimeError: # schedule queue full
+            self.sampler_missed += 1
+
+    def __swap_buffers(self):
+        # pairwise swaps do not allocate
+        self.__buf, self.__sbuf = self.__sbuf, self.__buf
+        self.__buf2, self.__sbuf2 = self.__sbuf2, self.__buf2
+        self.__sums, self.__ssums = self.__ssums, self.__sums
+        self.__vals, self.__svals = self.__svals, self.__vals
+
+    def __sample(self, _):
+        # scheduled between any two bytecodes of the program, maybe while
+        # __get_value() is filling the buffers: use the sampler's own set
+        self.__swap_buffers()
+        try:
+            if self._sampler_z_only:
+                self.updateZ()
+            else:
+                self.update()
+        finally:
+            self.__swap_buffers()
+        history = self.__history
+        if history is not None:
+            i = self.__history_head * 3
+            history[i] = self.angleX
+            history[i + 1] = self.angleY
+            history[i + 2] = self.angleZ
+            self.__history_head = (self.__history_head + 1) % (len(history) // 3)
+            if self.__history_count < len(history) // 3:
+                self.__history_count += 1
+
+    def get_history(self, buf):
+        """Copy the most recent sampler angles, oldest first, into buf (an
+        array('f') or list) as angleX, angleY, angleZ triples. Returns the
+        number of samples copied."""
+        history = self.__history
+        if history is None:
+            return 0
+        size = len(history) // 3
+        n = min(self.__history_count, len(buf) // 3)
+        start = self.__history_head - n
+        for k in range(n):
+            i = ((start + k) % size) * 3
+            j = k * 3
+            buf[j] = history[i]
+            buf[j + 1] = history[i + 1]
+            buf[j + 2] = history[i + 2]
+        return n
+
     def get_angleX(self):      
         return self.angleX
 
@@ -264,13 +652,67 @@ class Motion:
 
     def get_accels(self, n_samples=1):
         data = self.__get_value(None, n_samples)
-        return (data['AcX'], data['AcY'], data['AcZ'] - 1)
+        return (data[0], data[1], data[2] - 1)
 
     def get_gyros(self, n_samples=1):
         data = self.__get_value(None, n_samples)
-        return (data['GyX'] - self.gyroXoffs, data['GyY'] - self.gyroYoffs, data['GyZ'] - self.gyroZoffs)
+        return (data[3] - self.gyroXoffs, data[4] - self.gyroYoffs, data[5] - self.gyroZoffs)
+
+    def enable_shake_event(self, shake_threshold=0.5, duration=1, pin=None, callback=None):
+        """Let the MPU6050 motion detector latch shakes instead of polling.
+        shake_threshold is in g (2mg steps), duration in ms. If the INT line
+        is wired to pin, shakes are caught by a pin IRQ and was_shaked()
+        costs no I2C traffic; callback() is then scheduled on each shake.
+        Without pin, was_shaked() reads the one byte INT_STATUS register.
+        """
+        accel_config = self.__read_raw_data(ACCEL_CONFIG, 1)[0]
+        self.__register(ACCEL_CONFIG, (accel_config & 0x18) | 0x01) # 5Hz high pass for motion detection
+        self.__register(MOT_THR, max(1, min(255, int(shake_threshold / 0.002))))
+        self.__register(MOT_DUR, max(1, min(255, duration)))
+        self.__register(INT_PIN_CFG, 0x20) # INT latched until INT_STATUS is read
+        self.__register(INT_ENABLE, 0x40) # motion detection interrupt
+        self.__read_raw_data(INT_STATUS, 1)
+        self._shaked = False
+        self._shake_callback = callback
+        self._shake_pin = pin
+        if pin:
+            pin.irq(handler=self.__shake_irq, trigger=Pin.IRQ_RISING)
+        self._shake_event = True
+
+    def disable_shake_event(self):
+        if self._shake_pin:
+            self._shake_pin.irq(handler=None)
+            self._shake_pin = None
+        self.__register(INT_ENABLE, 0x00)
+        accel_config = self.__read_raw_data(ACCEL_CONFIG, 1)[0]
+        self.__register(ACCEL_CONFIG, accel_config & 0x18)
+        self._shake_event = False
+
+    def __shake_irq(self, _):
+        self._shaked = True
+        # clearing the latch needs I2C, do it from the scheduler
+        try:
+            schedule(self.__shake_ref, 0)
+        except RuntimeError:
+            pass
+
+    def __shake_handler(self, _):
+        self.__read_raw_data(INT_STATUS, 1) # clear the latched INT line
+        if self._shake_callback:
+            self._shake_callback()
+
+    def was_shaked(self):
+        """Return and clear the latched shake flag of the shake event mode"""
+        if not self._shake_pin:
+            if self.__read_raw_data(INT_STATUS, 1)[0] & 0x40:
+                self._shaked = True
+        shaked = self._shaked
+        self._shaked = False
+        return shaked
 
     def is_shaked(self, shake_threshold=4.0, avg_count=10, wait_time=0.1):
+        if self._shake_event:
+            return self.was_shaked()
         try:
             x = y = z = 0
             total = 0.0
@@ -284,12 +726,4 @@ class Motion:
         finally:
             return total > shake_threshold
 
-try:
-    from machine import SoftI2C
-    __i2c = SoftI2C(scl=Pin(22), sda=Pin(21), freq=200000)
-except Exception as e:
-    print("SoftI2C not exist. Using old I2C", e)
-    from machine import I2C
-    __i2c = I2C(scl=Pin(22), sda=Pin(21), freq=200000)
-
-motion = Motion(__i2c)
\ No newline at end of file
+motion = Lazy(lambda: Motion(get_i2c()))
@@ -1,11 +1,14 @@
 import machine, time, ustruct
-from micropython import const
+from micropython import const, schedule
 from machine import Pin
 from machine import I2C
+from makerbit_i2c import get_i2c
+from makerbit_lazy import Lazy
 
 #const = lambda x:x
 
 _COMMAND_BIT = const(0x80)
+_COMMAND_AUTO_INCREMENT = const(0x20)
 
 _REGISTER_ENABLE = const(0x00)
 _REGISTER_ATIME = const(0x01)
@@ -35,6 +38,9 @@ _ENABLE_PON = const(0x01)
 _GAINS = (1, 4, 16, 60)
 _CYCLES = (0, 1, 2, 3, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60)
 
+# gamma 2.5 correction of html_rgb(), computed once with the original formula
+_GAMMA = bytes(min(255, int(pow(i / 255, 2.5) * 255)) for i in range(256))
+
 COLOR = {
     'r': 0 ,
     'g': 1 ,
@@ -49,6 +55,17 @@ class TCS34725:
         self.i2c = i2c
         self.address = address
         self._active = False
+        self._continuous = False
+        self._ready = False
+        self._buf = bytearray(8)
+        self._gain = None
+        self._auto = False
+        self._target = 0.25
+        self._max_time = 24.0
+        self._int_pin = None
+        self._threshold_auto = False # auto-exposure to restore after on_threshold()
+        self._threshold_callback = None
+        self._threshold_ref = self._threshold_handler # bound once, used from the IRQ
         self.integration_time(2.4)
         sensor_id = self.sensor_id()
         if sensor_id not in (0x44, 0x10):
@@ -86,6 +103,15 @@ class TCS34725:
             self._register8(_REGISTER_ENABLE,
                 enable & ~(_ENABLE_PON | _ENABLE_AEN))
 
+    def continuous(self, value=None):
+        """Keep the sensor powered and integrating between reads, so read()
+        only fetches the last completed cycle in one 8 bytes burst"""
+        if value is None:
+            return self._continuous
+        self._continuous = bool(value)
+        self._ready = False
+        self.active(self._continuous)
+
     def sensor_id(self):
         return self._register8(_REGISTER_SENSORID)
 
@@ -97,17 +123,86 @@ class TCS34725:
         self._integration_time = cycles * 2.4
         return self._register8(_REGISTER_ATIME, 256 - cycles)
 
-    def gain(self, value):
+    def gain(self, value=None):
         if value is None:
-            return _GAINS[self._register8(_REGISTER_CONTROL)]
+            if self._gain is None:
+                self._gain = _GAINS[self._register8(_REGISTER_CONTROL) & 0x03]
+            return self._gain
         if value not in _GAINS:
             raise ValueError("gain must be 1, 4, 16 or 60")
+        self._gain = value
         return self._register8(_REGISTER_CONTROL, _GAINS.index(value))
 
+    def auto_exposure(self, value=None, target=0.25, max_time=24.0):
+        """Adjust gain and integration time after every read so the clear
+        channel stays around target (fraction of full scale), using the
+        shortest integration time possible, at most max_time ms"""
+        if value is None:
+            return self._auto or (self._int_pin is not None and self._threshold_auto)
+        if self._int_pin is not None:
+            # paused while a threshold is armed, applied by stop_threshold()
+            self._threshold_auto = bool(value)
+        else:
+            self._auto = bool(value)
+        self._target = target
+        self._max_time = max_time
+
+    def _adjust_exposure(self, c):
+        """Return True if the gain or integration time was changed"""
+        cycles = int(self._integration_time / 2.4 + 0.5)
+        level = c / min(65535, 1024 * cycles)
+        gain = self.gain()
+        index = _GAINS.index(gain)
+        # hysteresis: nothing changes while level is within target/2..target*2
+        if level > 0.9 or level > self._target * 2:
+            # too bright: shorten the integration first, then lower the gain
+            if cycles > 1:
+                self.integration_time(max(2.4, self._integration_time / 2))
+            elif index > 0 and level > 0.9:
+                self.gain(_GAINS[index - 1])
+            else:
+                return False
+        elif level < self._target / 2:
+            # too dark: raise the gain first as it costs no time
+            if index < len(_GAINS) - 1 and level * _GAINS[index + 1] / gain < 0.9:
+                self.gain(_GAINS[index + 1])
+            elif self._integration_time * 2 <= self._max_time:
+                self.integration_time(self._integration_time * 2)
+            else:
+                return False
+        else:
+            return False
+        if self._active:
+            # restart the cycle so the next read waits for a sample taken
+            # with the new settings instead of judging the stale one again
+            enable = self._register8(_REGISTER_ENABLE)
+            self._register8(_REGISTER_ENABLE, enable & ~_ENABLE_AEN)
+            self._register8(_REGISTER_ENABLE, enable | _ENABLE_AEN)
+            self._ready = False
+        return True
+
     def _valid(self):
         return bool(self._register8(_REGISTER_STATUS) & 0x01)
 
     def read(self, raw=False):
+        if self._continuous:
+            if not self._active:
+                self.active(True)
+                self._ready = False
+            if not self._ready:
+                # wait for the first integration cycle only
+                while not self._valid():
+                    time.sleep_ms(int(self._integration_time + 0.9))
+                self._ready = True
+            self.i2c.readfrom_mem_into(self.address,
+                _REGISTER_CDATA | _COMMAND_BIT | _COMMAND_AUTO_INCREMENT, self._buf)
+            c, r, g, b = ustruct.unpack_from('<HHHH', self._buf)
+            data = (r, g, b, c)
+            if self._auto:
+                self._adjust_exposure(c)
+            if raw:
+                return data
+            return self._temperature_and_lux(data)
         was_active = self.active()
         self.active(True)
         while not self._valid():
@@ -119,6 +214,8 @@ class TCS34725:
             _REGISTER_CDATA,
         ))
         self.active(was_active)
+        if self._auto:
+            self._adjust_exposure(data[3])
         if raw:
             return data
         return self._temperature_and_lux(data)
@@ -136,7 +233,7 @@ class TCS34725:
     def threshold(self, cycles=None, min_value=None, max_value=None):
         if cycles is None and min_value is None and max_value is None:
             min_value = self._register16(_REGISTER_AILT)
-            max_value = self._register16(_REGISTER_AILT)
+            max_value = self._register16(_REGISTER_AIHT)
             if self._register8(_REGISTER_ENABLE) & _ENABLE_AIEN:
                 cycles = _CYCLES[self._register8(_REGISTER_APERS) & 0x0f]
             else:
@@ -163,6 +260,43 @@ class TCS34725:
             raise ValueError("interrupt can only be cleared")
         self.i2c.writeto(self.address, b'\xe6')
 
+    def on_threshold(self, callback, pin, min_value, max_value, cycles=5):
+        """Call callback(clear) when the clear channel stays outside
+        min_value..max_value for cycles integration cycles. The sensor INT
+        line must be wired to pin (open drain, active low). No I2C traffic
+        happens until the interrupt fires.
+        min_value and max_value are raw clear counts for the current gain and
+        integration time, so auto-exposure is paused until stop_threshold()."""
+        self._threshold_callback = callback
+        if self._int_pin is None:
+            self._threshold_auto = self._auto
+        self._auto = False
+        self._int_pin = pin
+        self.active(True)
+        self.threshold(cycles, min_value, max_value)
+        self.interrupt(False)
+        pin.init(Pin.IN, Pin.PULL_UP)
+        pin.irq(handler=self._threshold_irq, trigger=Pin.IRQ_FALLING)
+
+    def stop_threshold(self):
+        if self._int_pin:
+            self._int_pin.irq(handler=None)
+            self._int_pin = None
+            self._auto = self._threshold_auto
+        self.threshold(-1)
+        self.interrupt(False)
+
+    def _threshold_irq(self, pin):
+        try:
+            schedule(self._threshold_ref, 0)
+        except RuntimeError:
+            pass
+
+    def _threshold_handler(self, _):
+        clear = self._register16(_REGISTER_CDATA)
+        self.interrupt(False) # release the INT line for the next event
+        if self._threshold_callback:
+            self._threshold_callback(clear)
 
     def html_rgb(self):
         r, g, b, c = self.read(True)
@@ -172,17 +306,10 @@ class TCS34725:
         # Avoid divide by zero errors ... if clear = 0 return black
         if c == 0:
             return (0, 0, 0)
-        red = int(pow((int((r/c) * 256) / 255), 2.5) * 255)
-        green = int(pow((int((g/c) * 256) / 255), 2.5) * 255)
-        blue = int(pow((int((b/c) * 256) / 255), 2.5) * 255)
-
-        # Handle possible 8-bit overflow
-        if red > 255:
-            red = 255
-        if green > 255:
-            green = 255
-        if blue > 255:
-            blue = 255
+        # int((r/c) * 256) with integer math, anything above 255 saturates
+        red = _GAMMA[min(255, (r << 8) // c)]
+        green = _GAMMA[min(255, (g << 8) // c)]
+        blue = _GAMMA[min(255, (b << 8) // c)]
         return (red, green, blue)        
         #return red, green, blue
 
@@ -190,17 +317,41 @@ class TCS34725:
         r, g, b = self.html_rgb()
         return "{0:02x}{1:02x}{2:02x}".format(int(r),int(g),int(b))
 
+# default html_rgb() centroid and radius of each color, replaced by train().
+# A reading belongs to the nearest color relative to its radius, and to no
+# color if it is outside that radius. The lowest readings of the old
+# threshold detect() keep their color: red (45, 0, 0) or (90, 0, 0),
+# green (0, 45, 0), blue (0, 0, 45), dark (0, 0, 0), white (16, 16, 16),
+# yellow (30, 15, 4). Like the old yellow box, the radius of yellow is tight.
+_CENTROIDS = {
+    'r': (68, 2, 2, 26),
+    'g': (2, 68, 2, 26),
+    'b': (2, 2, 68, 26),
+    'd': (0, 0, 0, 12),
+    'w': (20, 20, 20, 15),
+    'y': (31, 19, 4, 6)
+}
+_TRAINED_RADIUS = const(10) # smallest radius given by train()
+
+_COLORS_FILE = 'color_samples.bin'
+_COLORS_FORMAT = const(3) # first byte of the file, 2 had no radius, older files no header
+
 class ColorSensor():
     
     def __init__(self, address = 0x29):
         self.address = address
-        scl_pin = machine.Pin(22)
-        sda_pin = machine.Pin(21)
         try:
-            self.tcs = TCS34725(machine.SoftI2C(scl=scl_pin, sda=sda_pin), self.address)
+            self.tcs = TCS34725(get_i2c(), self.address)
+            self.tcs.continuous(True)
+            self.tcs.auto_exposure(True)
         except:
             print('Color sensor not found')
             raise Exception('Color sensor not found')
+        self._centroids = dict(_CENTROIDS)
+        self._label = None
+        self._score = 0
+        self._label_ticks = 0
+        self.load_colors()
 
     def read(self, color):
         '''
@@ -210,38 +361,104 @@ class ColorSensor():
         '''
         return self.tcs.html_rgb()[COLOR[color]]
 
-    def detect(self, color, limit = 40):
+    def classify(self, tolerance=1.0):
         '''
-        Maybe the readings from the sensor will be different: white (45, 45, 45) or red (90, 0, 0)
-        Below is the lowest value the sensor reads for each color:
-        Color:  red (45, 0, 0)  
-                green(0, 45, 0)
-                blue (0, 45, 0)
-                dark (0, 0, 0)
-                white(16, 16, 16)
-                yellow (30, 15, 4)
+        Read the sensor once and return the label ('r', 'g', 'b', 'd', 'w', 'y'
+        or a trained one) of the nearest color centroid in html_rgb space,
+        None if the reading is farther than tolerance times the radius of
+        that color.
+        The reading is reused until the sensor completes a new cycle.
         '''
-        r, g, b = self.tcs.html_rgb()
-        if max(r, g, b, limit) == r:
-            #red
-            return 0 == COLOR[color]
-        elif max(r, g, b, limit) == g:
-            #green
-            return 1 == COLOR[color]
-        elif max(r, g, b, limit) == b:
-            #blue
-            return 2 == COLOR[color]
-        elif max(r, g, b) < (limit/3):
-            #black
-            return 3 == COLOR[color]
-        elif min(r, g, b) > (limit/3):
-            #white
-            return 4 == COLOR[color]
-        elif ((26 < r < 36) and (14 < g < 24) and (0 < b < 8)):
-            #yellow
-            return 5 == COLOR[color]
-        else:
-            #other colors
+        now = time.ticks_ms()
+        if self._label is None or time.ticks_diff(now, self._label_ticks) >= self.tcs.integration_time():
+            r, g, b = self.tcs.html_rgb()
+            label = None
+            best = 0
+            for name, (cr, cg, cb, radius) in self._centroids.items():
+                # squared distance in radii of that color
+                d = ((r - cr) * (r - cr) + (g - cg) * (g - cg) + (b - cb) * (b - cb)) / (radius * radius)
+                if label is None or d < best:
+                    label = name
+                    best = d
+            self._label = label
+            self._score = best
+            self._label_ticks = now
+        if self._score > tolerance * tolerance:
+            return None
+        return self._label
+
+    def train(self, color, n_samples=5, save=True):
+        '''
+        Record the color currently under the sensor as the centroid of color,
+        averaged over n_samples readings, and store it on flash if save.
+        The radius of the color is the spread of the readings, at least
+        _TRAINED_RADIUS. color can be any label of 1 to 255 bytes, e.g. 'orange'.
+        '''
+        if not isinstance(color, str) or not 0 < len(color.encode()) < 256:
+            raise ValueError('color must be a label of 1 to 255 bytes')
+        sr = sg = sb = 0
+        low = [255, 255, 255]
+        high = [0, 0, 0]
+        for _ in range(n_samples):
+            r, g, b = self.tcs.html_rgb()
+            sr += r
+            sg += g
+            sb += b
+            for i, v in ((0, r), (1, g), (2, b)):
+                low[i] = min(low[i], v)
+                high[i] = max(high[i], v)
+            time.sleep_ms(int(self.tcs.integration_time() + 0.9))
+        spread = sum((high[i] - low[i]) * (high[i] - low[i]) for i in range(3)) ** 0.5
+        radius = min(255, max(_TRAINED_RADIUS, int(spread + 0.5)))
+        self._centroids[color] = (sr // n_samples, sg // n_samples, sb // n_samples, radius)
+        self._label = None
+        if save:
+            self.save_colors()
+
+    def save_colors(self, path=_COLORS_FILE):
+        # per color: label length, label (utf-8), r, g, b, radius
+        data = bytearray((_COLORS_FORMAT,))
+        for name, centroid in self._centroids.items():
+            label = name.encode()
+            data.append(len(label))
+            data.extend(label)
+            data.extend(bytes(centroid))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def load_colors(self, path=_COLORS_FILE):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
             return False
+        if data and data[0] in (2, _COLORS_FORMAT):
+            size = 4 if data[0] == _COLORS_FORMAT else 3
+            i = 1
+            while i < len(data):
+                n = data[i]
+                if i + 1 + n + size > len(data):
+                    break
+                name = data[i + 1:i + 1 + n].decode()
+                i += 1 + n
+                radius = data[i + 3] if size == 4 else _TRAINED_RADIUS
+                self._centroids[name] = (data[i], data[i + 1], data[i + 2], radius)
+                i += size
+        else:
+            # 4 bytes per color: one character label, r, g, b
+            for i in range(0, len(data) - 3, 4):
+                self._centroids[chr(data[i])] = (data[i + 1], data[i + 2], data[i + 3], _TRAINED_RADIUS)
+        self._label = None
+        return True
+
+    def detect(self, color, limit = 40):
+        '''
+        Return True if the color under the sensor is classified as color,
+        False for any other color or none.
+        Several detect() calls within one sensor cycle share one reading.
+        limit scales the radius of every color, 40 keeps them as set by
+        _CENTROIDS and train().
+        '''
+        return self.classify(limit / 40) == color
 
-color_sensor = ColorSensor()
+color_sensor = Lazy(ColorSensor)
\ No newline at end of file
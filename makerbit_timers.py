@@ -0,0 +1,26 @@
+from machine import Timer
+
+# The ESP32 has four hardware timers. Default use by the Maker:Bit drivers:
+#   0  HCSR04Scheduler
+#   1  DCMotors motion queue (moves with wait=False)
+#   2  Motion.start_sampler(), LineFollower
+#   3  IR_RX
+# Every driver takes a timer_id argument to move to another timer. A timer
+# can only be held by one object at a time, claiming a busy one raises
+# RuntimeError instead of silently replacing the other driver's callback.
+_owners = {}
+
+def claim_timer(timer_id, owner):
+    """Return hardware timer timer_id for owner, RuntimeError if another
+    object holds it"""
+    holder = _owners.get(timer_id)
+    if holder is not None and holder is not owner:
+        raise RuntimeError("timer {} is used by {}, pass another timer_id".format(
+            timer_id, type(holder).__name__))
+    _owners[timer_id] = owner
+    return Timer(timer_id)
+
+def release_timer(timer_id, owner):
+    """Give timer_id back, nothing happens if owner does not hold it"""
+    if _owners.get(timer_id) is owner:
+        del _owners[timer_id]
@@ -1,11 +1,18 @@
 import ustruct
 import time
+from array import array
 
 
 class PCA9685:
     def __init__(self, i2c, address=0x40):
         self.i2c = i2c
         self.address = address
+        # shadow copy of the ON/OFF registers of the 16 channels, a channel
+        # is only trusted once its bit is set in self._known
+        self._on = array('H', [0] * 16)
+        self._off = array('H', [0] * 16)
+        self._known = 0
+        self._prescale = None
         self.reset()
 
     def _write(self, address, value):
@@ -15,12 +22,15 @@ class PCA9685:
         return self.i2c.readfrom_mem(self.address, address, 1)[0]
 
     def reset(self):
-        self._write(0x00, 0x00) # Mode1
+        self._write(0x00, 0x20) # Mode1, autoincrement on
 
     def freq(self, freq=None):
         if freq is None:
             return int(25000000.0 / 4096 / (self._read(0xfe) - 0.5))
         prescale = int(25000000.0 / 4096.0 / freq + 0.5)
+        if prescale == self._prescale:
+            return # already programmed, e.g. by DCMotors then Servos
+        self._prescale = prescale
         old_mode = self._read(0x00) # Mode 1
         self._write(0x00, (old_mode & 0x7F) | 0x10) # Mode 1, sleep
         self._write(0xfe, prescale) # Prescale
@@ -28,32 +38,94 @@ class PCA9685:
         time.sleep_us(5)
         self._write(0x00, old_mode | 0xa1) # Mode 1, autoincrement on
 
-    def pwm(self, index, on=None, off=None):
+    def sync(self, index=None):
+        """Reload the shadow registers from the chip, all channels by default"""
+        if index is None:
+            start, count = 0, 16
+        else:
+            start, count = index, 1
+        data = self.i2c.readfrom_mem(self.address, 0x06 + 4 * start, 4 * count)
+        for i in range(count):
+            self._on[start + i], self._off[start + i] = ustruct.unpack_from('<HH', data, 4 * i)
+            self._known |= 1 << (start + i)
+
+    def _cached(self, index, on, off):
+        return (self._known >> index) & 1 and self._on[index] == on and self._off[index] == off
+
+    def _store(self, index, on, off):
+        self._on[index] = on
+        self._off[index] = off
+        self._known |= 1 << index
+
+    def pwm(self, index, on=None, off=None, sync=False):
         if on is None or off is None:
-            data = self.i2c.readfrom_mem(self.address, 0x06 + 4 * index, 4)
-            return ustruct.unpack('<HH', data)
+            if sync or not (self._known >> index) & 1:
+                self.sync(index)
+            return (self._on[index], self._off[index])
+        if self._cached(index, on, off):
+            return
         data = ustruct.pack('<HH', on, off)
         self.i2c.writeto_mem(self.address, 0x06 + 4 * index,  data)
+        self._store(index, on, off)
+
+    def pwm_range(self, start, values):
+        """Write (on, off) pairs to consecutive channels from start in one
+        auto-incremented I2C transaction, skipping unchanged channels at
+        both ends"""
+        end = len(values)
+        while end and self._cached(start + end - 1, *values[end - 1]):
+            end -= 1
+        first = 0
+        while first < end and self._cached(start + first, *values[first]):
+            first += 1
+        if first == end:
+            return
+        data = bytearray(4 * (end - first))
+        for i in range(first, end):
+            on, off = values[i]
+            ustruct.pack_into('<HH', data, 4 * (i - first), on, off)
+        self.i2c.writeto_mem(self.address, 0x06 + 4 * (start + first), data)
+        for i in range(first, end):
+            self._store(start + i, *values[i])
+
+    def pwm_many(self, channels):
+        """Write a dict of {index: (on, off)}, one transaction per run of
+        contiguous changed channels"""
+        indexes = sorted(index for index in channels
+                         if not self._cached(index, *channels[index]))
+        start = 0
+        for i in range(1, len(indexes) + 1):
+            if i == len(indexes) or indexes[i] != indexes[i - 1] + 1:
+                self.pwm_range(indexes[start],
+                    [channels[index] for index in indexes[start:i]])
+                start = i
 
-    def duty(self, index, value=None, invert=False):
+    def _duty2pwm(self, value, invert=False):
+        if not 0 <= value <= 4095:
+            raise ValueError("Out of range")
+        if invert:
+            value = 4095 - value
+        if value == 0:
+            return (0, 4096)
+        elif value == 4095:
+            return (4096, 0)
+        return (0, value)
+
+    def duty(self, index, value=None, invert=False, sync=False):
         if value is None:
-            pwm = self.pwm(index)
+            pwm = self.pwm(index, sync=sync)
             if pwm == (0, 4096):
                 value = 0
             elif pwm == (4096, 0):
                 value = 4095
-            value = pwm[1]
+            else:
+                value = pwm[1]
             if invert:
                 value = 4095 - value
             return value
-        if not 0 <= value <= 4095:
-            raise ValueError("Out of range")
-        if invert:
-            value = 4095 - value
-        if value == 0:
-            self.pwm(index, 0, 4096)
-        elif value == 4095:
-            self.pwm(index, 4096, 0)
-        else:
-            self.pwm(index, 0, value)
+        on, off = self._duty2pwm(value, invert)
+        self.pwm(index, on, off)
+
+    def duty_range(self, start, values, invert=False):
+        self.pwm_range(start, [self._duty2pwm(value, invert) for value in values])
 
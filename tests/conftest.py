@@ -0,0 +1,7 @@
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'stubs'))
+
+import host
+
+host.install()
@@ -0,0 +1,16 @@
+"""Make the MicroPython drivers importable on CPython"""
+import builtins, os, sys, time
+
+STUBS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(STUBS))
+
+
+def install():
+    for path in (ROOT, STUBS):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import micropython, utime
+    builtins.const = micropython.const
+    for name in ('ticks_us', 'ticks_ms', 'ticks_diff', 'ticks_add',
+                 'sleep_us', 'sleep_ms'):
+        setattr(time, name, getattr(utime, name))
@@ -0,0 +1,86 @@
+"""Minimal machine module to run the drivers on CPython"""
+
+
+class Pin:
+    IN = 1
+    OUT = 2
+    PULL_UP = 1
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id=None, mode=None, pull=None, value=None):
+        self.id = id
+        self._value = value or 0
+        self.handler = None
+        self.irq_args = {}
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def irq(self, handler=None, trigger=None, **kwargs):
+        self.handler = handler
+        self.irq_args = kwargs
+
+
+class I2C:
+    """I2C bus backed by a dict of (address, register) -> byte"""
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.mem = {}
+
+    def writeto_mem(self, addr, reg, data):
+        for i, b in enumerate(data):
+            self.mem[(addr, reg + i)] = b
+
+    def readfrom_mem(self, addr, reg, n):
+        return bytes(self.mem.get((addr, reg + i), 0) for i in range(n))
+
+    def readfrom_mem_into(self, addr, reg, buf):
+        for i in range(len(buf)):
+            buf[i] = self.mem.get((addr, reg + i), 0)
+
+    def writeto(self, addr, data):
+        for i, b in enumerate(data[1:]):
+            self.mem[(addr, data[0] + i)] = b
+
+
+SoftI2C = I2C
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.callback = None
+        self.period = None
+
+    def init(self, period=None, mode=None, callback=None, freq=None):
+        self.period = period
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+    def fire(self):
+        if self.callback:
+            self.callback(self)
+
+
+def time_pulse_us(pin, level, timeout_us=1000000):
+    return -1
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state):
+    pass
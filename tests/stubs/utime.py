@@ -0,0 +1,28 @@
+"""Deterministic clock: only sleep_ms()/sleep_us() move time forward"""
+
+_now_us = 0
+
+
+def ticks_us():
+    return _now_us
+
+
+def ticks_ms():
+    return _now_us // 1000
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def sleep_us(us):
+    global _now_us
+    _now_us += us
+
+
+def sleep_ms(ms):
+    sleep_us(int(ms * 1000))
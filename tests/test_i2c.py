@@ -0,0 +1,19 @@
+import machine
+
+import makerbit_i2c
+from makerbit_i2c import get_i2c
+
+
+def test_each_pin_pair_gets_its_own_bus(monkeypatch):
+    monkeypatch.setattr(makerbit_i2c, '_buses', {})
+    monkeypatch.setattr(makerbit_i2c, '_freqs', {})
+    monkeypatch.setattr(makerbit_i2c, '_hw_used', [])
+    main = get_i2c()
+    assert get_i2c() is main
+    other = get_i2c(scl=19, sda=18)
+    third = get_i2c(scl=5, sda=4)
+    # hardware I2C IDs are singletons on the ESP32, never reuse one
+    assert main.args == (0,)
+    assert other.args == (1,)
+    assert isinstance(third, machine.SoftI2C) and third.args == ()
+    assert makerbit_i2c.i2c_freq(19, 18) == 400000
@@ -0,0 +1,126 @@
+import pytest
+import utime
+from machine import Pin
+
+import makerbit_ir_receiver
+from makerbit_ir_receiver import IR_RX
+
+
+def nec(cmd, addr):
+    # mark/space durations in µs of a NEC frame
+    val = addr | ((addr ^ 0xff) << 8) | (cmd << 16) | ((cmd ^ 0xff) << 24)
+    durations = [9000, 4500]
+    for i in range(32):
+        durations += [560, 1690 if (val >> i) & 1 else 560]
+    return durations + [560]
+
+
+@pytest.fixture
+def ir():
+    ir = IR_RX(Pin(15))
+    yield ir
+    ir.stop() # gives the timer back
+
+
+def send(ir, durations, gap=200000):
+    utime._now_us += gap
+    ir._cb_pin(None)
+    for d in durations:
+        utime._now_us += d
+        ir._cb_pin(None)
+
+
+def test_decode_falls_back_to_block_timer_when_schedule_is_full(ir, monkeypatch):
+    calls = []
+
+    def full(func, arg):
+        calls.append(func)
+        raise RuntimeError('schedule queue full')
+
+    monkeypatch.setattr(makerbit_ir_receiver, 'schedule', full)
+    send(ir, nec(0x40, 0))
+    assert calls and not ir._done
+    monkeypatch.undo()
+    ir._tim.fire() # block timer
+    assert ir.get_code() == 0x40
+
+    ir._tim.fire() # release timer
+    send(ir, nec(0x19, 0))
+    assert ir.get_code() == 0x19
+
+
+def test_key_released_after_noise_frame(ir):
+    send(ir, nec(0x40, 0))
+    assert ir.get_code() == 0x40
+    # a stray edge while the key is held turns into a _BADSTART frame
+    utime._now_us += 50000
+    ir._cb_pin(None)
+    ir._tim.fire() # block timer
+    assert ir.get_code() == 0x40
+    ir._tim.fire() # release timer, armed again after the error
+    assert ir.get_code() is None
+    assert not ir._held
+
+
+def test_repeat_rate_and_release_time(ir):
+    from makerbit_ir_receiver import IR_PRESS, IR_HOLD, IR_RELEASE
+    assert ir.repeat() == (120, 0)
+    ir.repeat(release_ms=200, hold_repeat_ms=300)
+    assert ir.repeat() == (200, 300)
+
+    send(ir, nec(0x40, 0))
+    for _ in range(6):
+        # NEC repeat code every 108 ms while the key is held
+        send(ir, [9000, 2250, 560], gap=108000 - 11810)
+        assert ir._tim.period == 200 # release timer
+    ir._tim.fire()
+    kinds = []
+    while ir.available():
+        kinds.append(ir.read_event()[3])
+    # hold events no closer than 300 ms: after 324 and 648 ms
+    assert kinds == [IR_PRESS, IR_HOLD, IR_HOLD, IR_RELEASE]
+    assert ir.get_code() is None
+
+
+def test_event_pushed_while_reading():
+    from array import array
+    from makerbit_ir_receiver import IR_PRESS
+
+    class Ring(array):
+        # runs the decoder once, right after read_event() took its indexes
+        hook = None
+
+        def __getitem__(self, i):
+            hook, Ring.hook = Ring.hook, None
+            if hook:
+                hook()
+            return array.__getitem__(self, i)
+
+    ir = IR_RX(Pin(16), queue_size=4, timer_id=1)
+    try:
+        ir._events = Ring('i', ir._events)
+        for cmd in (1, 2, 3, 4):
+            ir._push_event(cmd, 0, IR_PRESS)
+        # the ring is full, the decoder overwrites event 1 during the read
+        Ring.hook = lambda: ir._push_event(5, 0, IR_PRESS)
+        cmds = []
+        while ir.available():
+            cmds.append(ir.read_event()[0])
+        assert cmds == [2, 3, 4, 5]
+        assert ir.overflows == 1
+        assert ir.read_event() is None
+    finally:
+        ir.stop()
+
+
+def test_event_counters_wrap():
+    from makerbit_ir_receiver import IR_PRESS
+    ir = IR_RX(Pin(16), queue_size=3, timer_id=1)
+    try:
+        ir._event_in = ir._event_out = ir._event_wrap - 2
+        for cmd in range(1, 8):
+            ir._push_event(cmd, 0, IR_PRESS)
+            assert ir.read_event()[0] == cmd
+        assert ir._event_in == 5 and ir.available() == 0
+    finally:
+        ir.stop()
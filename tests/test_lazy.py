@@ -0,0 +1,62 @@
+import pytest
+
+import makerbit
+import makerbit_motion
+import makerbit_tcs34725
+from makerbit_i2c import get_i2c
+from makerbit_lazy import Lazy
+
+
+class Thing:
+    def __init__(self):
+        self.value = 0
+
+
+def test_assignment_reaches_the_object():
+    built = []
+
+    def factory():
+        built.append(Thing())
+        return built[-1]
+
+    proxy = Lazy(factory)
+    assert not built
+    proxy.value = 5
+    assert len(built) == 1 and built[0].value == 5
+    assert proxy.value == 5
+    proxy.other = 1
+    assert built[0].other == 1
+    assert proxy._obj is built[0]
+
+
+@pytest.fixture
+def singletons(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # no color_samples.bin
+    get_i2c().mem[(0x29, 0x80 | 0x12)] = 0x44 # TCS34725 id
+    proxies = (makerbit.ir_rx, makerbit.pca9685_obj, makerbit.motor,
+               makerbit.servo, makerbit_motion.motion, makerbit_tcs34725.color_sensor)
+    yield proxies
+    makerbit.ir_rx._get().stop() # gives timer 3 back
+    for proxy in proxies:
+        proxy._obj = None
+    makerbit._pca9685_obj = None
+
+
+def test_assign_through_each_singleton(singletons):
+    for proxy in singletons:
+        proxy.custom = 7
+        assert proxy._obj is not None
+        assert proxy._obj.custom == 7
+        assert proxy.custom == 7
+
+    makerbit.ir_rx.hold_repeat_ms = 300
+    assert makerbit.ir_rx._obj.hold_repeat_ms == 300
+    makerbit.ir_rx.verbose = True
+    assert makerbit.ir_rx._obj.verbose
+
+    motion = makerbit_motion.motion
+    motion.begin()
+    motion.angleZ = 42.0
+    assert motion.get_angleZ() == 42.0
+    motion.angleZ = 0.0
+    assert motion.get_angleZ() == 0.0
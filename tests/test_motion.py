@@ -0,0 +1,58 @@
+import os, struct, sys, time
+
+import machine
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import bench_fusion
+from makerbit_motion import Motion
+
+
+@pytest.mark.parametrize('engine', ['complementary', 'madgwick'])
+def test_engines_track_the_synthetic_trace(engine):
+    rows = bench_fusion.synthetic_trace()
+    _, angles = bench_fusion.run(engine, rows)
+    noise, drift, error = bench_fusion.stats(rows, angles)
+    assert error < 1 # degrees of tilt, whole trace
+    assert noise < 0.5
+    # 0.3 deg/s of gyro bias left, about 18 deg/min, neither engine can see it
+    assert drift < 30
+
+
+def motion_with_constant_input():
+    bus = machine.I2C()
+    motion = Motion(bus)
+    raw = struct.pack('>7h', 4000, -2000, 16000, 0, 200, -100, 50)
+    for i, b in enumerate(raw):
+        bus.mem[(0x68, 0x3b + i)] = b
+    return motion
+
+
+def test_sample_during_calibrate_does_not_mix_buffers(monkeypatch):
+    motion = motion_with_constant_input()
+    motion.calibrate(10)
+    expected = (motion.acXoffs, motion.acYoffs, motion.acZoffs,
+                motion.gyroXoffs, motion.gyroYoffs, motion.gyroZoffs)
+    motion.begin()
+    motion.start_sampler(history=4)
+    try:
+        fired = []
+        sleep_ms = time.sleep_ms
+
+        def sleep_and_sample(ms):
+            # the scheduler runs the sampler while calibrate() sleeps
+            if len(fired) < 3:
+                fired.append(1)
+                motion._sampler.fire()
+            sleep_ms(ms)
+
+        monkeypatch.setattr(time, 'sleep_ms', sleep_and_sample)
+        motion.calibrate(10, sleep=1)
+        assert fired
+        got = (motion.acXoffs, motion.acYoffs, motion.acZoffs,
+               motion.gyroXoffs, motion.gyroYoffs, motion.gyroZoffs)
+        assert got == pytest.approx(expected)
+        assert motion.get_accels() == pytest.approx((expected[0], expected[1], expected[2] - 1))
+    finally:
+        motion.stop_sampler()
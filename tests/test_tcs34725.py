@@ -0,0 +1,208 @@
+import os, sys
+
+import pytest
+
+import makerbit_tcs34725
+from makerbit_tcs34725 import COLOR, ColorSensor, _CENTROIDS
+
+
+class FakeTCS:
+    def __init__(self, rgb=(0, 0, 0)):
+        self.rgb = rgb
+
+    def html_rgb(self):
+        return self.rgb
+
+    def integration_time(self):
+        return 2.4
+
+
+def color_sensor(rgb=(0, 0, 0)):
+    sensor = ColorSensor.__new__(ColorSensor)
+    sensor.tcs = FakeTCS(rgb)
+    sensor._centroids = dict(_CENTROIDS)
+    sensor._label = None
+    sensor._score = 0
+    sensor._label_ticks = 0
+    return sensor
+
+
+def old_detect(rgb, limit=40):
+    # threshold chain of detect() before the centroid classifier
+    r, g, b = rgb
+    if max(r, g, b, limit) == r:
+        return 'r'
+    elif max(r, g, b, limit) == g:
+        return 'g'
+    elif max(r, g, b, limit) == b:
+        return 'b'
+    elif max(r, g, b) < (limit / 3):
+        return 'd'
+    elif min(r, g, b) > (limit / 3):
+        return 'w'
+    elif (26 < r < 36) and (14 < g < 24) and (0 < b < 8):
+        return 'y'
+    return None
+
+
+# documented readings of the old detect(), lowest value of each color
+@pytest.mark.parametrize('rgb, color', [
+    ((45, 0, 0), 'r'),
+    ((90, 0, 0), 'r'),
+    ((0, 45, 0), 'g'),
+    ((0, 0, 45), 'b'),
+    ((0, 0, 0), 'd'),
+    ((16, 16, 16), 'w'),
+    ((30, 15, 4), 'y'),
+    ((30, 5, 5), None), # dim red, no color
+])
+def test_reference_readings(rgb, color):
+    assert old_detect(rgb) == color
+    sensor = color_sensor(rgb)
+    assert sensor.classify() == color
+    for label in COLOR:
+        assert sensor.detect(label) == (label == color), label
+
+
+class FakeTCSBus:
+    """TCS34725 model: data is latched at the end of each integration cycle
+    with the gain and integration time of that moment"""
+    def __init__(self, light):
+        self.light = light # clear count per cycle at gain 1
+        self.regs = bytearray(32)
+        self.regs[0x12] = 0x44
+        self.cycle_start = None
+        self.valid = False
+
+    def _cycle_ms(self):
+        return (256 - self.regs[0x01]) * 2.4
+
+    def _update(self):
+        if self.cycle_start is None:
+            return
+        now = makerbit_tcs34725.time.ticks_us() / 1000
+        while now - self.cycle_start >= self._cycle_ms():
+            self.cycle_start += self._cycle_ms()
+            gain = (1, 4, 16, 60)[self.regs[0x0f] & 0x03]
+            c = min(65535, self.light * gain * (256 - self.regs[0x01]))
+            self.regs[0x14] = c & 0xff
+            self.regs[0x15] = c >> 8
+            self.valid = True
+        self.regs[0x13] = self.valid
+
+    def writeto_mem(self, addr, reg, data):
+        reg &= 0x1f
+        if reg == 0x00:
+            if data[0] & 0x02 and not self.regs[0] & 0x02:
+                self.cycle_start = makerbit_tcs34725.time.ticks_us() / 1000
+                self.valid = False
+            elif not data[0] & 0x02:
+                self.cycle_start = None
+                self.valid = False
+        self.regs[reg:reg + len(data)] = data
+
+    def readfrom_mem(self, addr, reg, n):
+        self._update()
+        reg &= 0x1f
+        return bytes(self.regs[reg:reg + n])
+
+    def readfrom_mem_into(self, addr, reg, buf):
+        buf[:] = self.readfrom_mem(addr, reg, len(buf))
+
+    def writeto(self, addr, data):
+        pass
+
+
+def test_auto_exposure_waits_for_fresh_sample():
+    tcs = makerbit_tcs34725.TCS34725(FakeTCSBus(100))
+    tcs.gain(1)
+    tcs.continuous(True)
+    tcs.auto_exposure(True)
+    for _ in range(6):
+        # each reading must have been taken with the settings it is judged by
+        expected = 100 * tcs.gain() * int(tcs.integration_time() / 2.4 + 0.5)
+        assert tcs.read(True)[3] == min(65535, expected)
+
+
+def test_gamma_table_matches_formula():
+    import random
+    sys_path = os.path.join(os.path.dirname(__file__), '..', 'benchmarks')
+    if sys_path not in sys.path:
+        sys.path.insert(0, sys_path)
+    from bench_html_rgb import new_html_rgb, old_html_rgb, readings
+
+    rows = readings(100000, seed=2)
+    # every raw value for small clear counts, a bit above c as well
+    for c in range(1, 400):
+        values = list(range(0, c + 21))
+        values += [0] * (-len(values) % 3)
+        for i in range(0, len(values), 3):
+            rows.append((values[i], values[i + 1], values[i + 2], c))
+    # both sides of every rounding step of (x << 8) // c
+    rnd = random.Random(3)
+    for c in rnd.sample(range(400, 65536), 300):
+        for k in range(0, 257, 3):
+            x = k * c // 256
+            rows.append((max(0, x - 1), x, min(65535, x + 1), c))
+    rows.append((0, 0, 0, 0))
+    html_rgb = new_html_rgb(rows)
+    for row in rows:
+        assert html_rgb() == old_html_rgb(*row), row
+
+
+def test_trained_labels_are_saved_and_loaded(tmp_path):
+    path = str(tmp_path / 'colors.bin')
+    sensor = color_sensor((40, 20, 0))
+    sensor.train('orange', n_samples=2, save=False)
+    sensor.train('đỏ', n_samples=1, save=False)
+    sensor.save_colors(path)
+    loaded = color_sensor()
+    assert loaded.load_colors(path)
+    assert loaded._centroids == sensor._centroids
+    assert loaded._centroids['orange'] == (40, 20, 0, 10)
+    assert loaded.classify() == 'd'
+
+
+def test_trained_color_radius_and_limit():
+    sensor = color_sensor((40, 20, 0))
+    sensor.train('orange', n_samples=3, save=False)
+    assert sensor.classify() == 'orange'
+    sensor._label = None
+    sensor.tcs.rgb = (40, 35, 0) # 15 away, radius 10
+    assert sensor.classify() is None
+    assert not sensor.detect('orange')
+    assert sensor.detect('orange', limit=80) # twice the radius
+
+
+@pytest.mark.parametrize('label', ['', 'x' * 256, 3])
+def test_invalid_label_changes_nothing(label):
+    sensor = color_sensor()
+    with pytest.raises(ValueError):
+        sensor.train(label, save=False)
+    assert sensor._centroids == _CENTROIDS
+
+
+def test_load_colors_reads_one_character_records(tmp_path):
+    path = tmp_path / 'colors.bin'
+    path.write_bytes(bytes((ord('r'), 80, 1, 2, ord('k'), 9, 9, 9)))
+    sensor = color_sensor()
+    assert sensor.load_colors(str(path))
+    assert sensor._centroids['r'] == (80, 1, 2, 10)
+    assert sensor._centroids['k'] == (9, 9, 9, 10)
+
+
+def test_auto_exposure_paused_while_threshold_armed():
+    from machine import Pin
+    tcs = makerbit_tcs34725.TCS34725(FakeTCSBus(100))
+    tcs.gain(1)
+    tcs.continuous(True)
+    tcs.auto_exposure(True)
+    tcs.on_threshold(lambda clear: None, Pin(4), 50, 500)
+    for _ in range(4):
+        tcs.read(True)
+    # the armed window is in raw counts of gain 1, 2.4 ms
+    assert tcs.gain() == 1 and tcs.integration_time() == 2.4
+    assert tcs.auto_exposure()
+    tcs.stop_threshold()
+    tcs.read(True)
+    assert tcs.gain() == 4
@@ -0,0 +1,52 @@
+import pytest
+
+from makerbit import DCMotors
+from makerbit_linefinder import LineFinder, LineFollower, S1_IN_S2_IN
+from makerbit_timers import claim_timer, release_timer
+
+
+class FakePCA9685:
+    def freq(self, value=None):
+        pass
+
+    def pwm_many(self, channels):
+        pass
+
+
+class FakeLineFinder:
+    def read(self):
+        return S1_IN_S2_IN
+
+
+def test_motion_queue_and_line_follower_use_different_timers():
+    motor = DCMotors(FakePCA9685())
+    follower = LineFollower(FakeLineFinder(), motor)
+    done = []
+    motor.forward(40, t=1, wait=False, callback=lambda: done.append(1))
+    follower.start()
+    try:
+        assert follower._timer is not motor._timer
+        motor._timer.fire()
+        assert done == [1]
+        assert not motor.busy()
+    finally:
+        follower.stop()
+
+
+def test_timer_clash_is_reported():
+    motor = DCMotors(FakePCA9685(), timer_id=2)
+    follower = LineFollower(FakeLineFinder(), motor, timer_id=2)
+    follower.start()
+    try:
+        with pytest.raises(RuntimeError):
+            motor.forward(40, t=1, wait=False)
+        assert not motor.busy()
+    finally:
+        follower.stop()
+    # released by stop(), the queue can use it now
+    motor.forward(40, t=1, wait=False)
+    assert motor.busy()
+    motor.cancel()
+    owner = object()
+    claim_timer(2, owner)
+    release_timer(2, owner)